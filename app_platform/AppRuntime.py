@@ -0,0 +1,300 @@
+# Runs CPU bound inspection apps on worker processes behind one SocketInterface.
+#
+# A single receiver copies every frame once into a SharedFrameRing, the workers
+# map the ring and read the frame in place, so an app costs no extra transport
+# or copy. Results of all apps of a frame are handed to onResult in frame order.
+# Each app has its own concurrency limit, a crashed worker is restarted and its
+# running tasks are reported as failed.
+#
+#   runtime = AppRuntime({"blob": "blobApp:inspect", "ocr": ("ocrApp:read", 2)}, onResult=publish)
+#   await runtime.run(os.environ["webapp1_host"])
+#
+# An app is a "module:function" importable in the worker (or a picklable top level
+# function), called as function(image, meta) and returning a picklable result.
+import asyncio
+import importlib
+import inspect
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Callable, Dict, Union
+
+import numpy as np
+import zmq
+
+from IPCHelper import SharedFrameRing, SharedMemoryFull, SocketInterface, StaleFrameError
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+def resolveApp(app: Union[str, Callable]) -> Callable:
+    if callable(app):
+        return app
+    module, function = app.split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def workerMain(index: int, apps: dict, ringPath: str, tasks, results) -> None:
+    functions = {name: resolveApp(app) for name, app in apps.items()}
+    ring: SharedFrameRing = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        taskId, name, slot, generation, ringId, shape, dtype, meta = task
+        try:
+            if ring is None or ring.ringId != ringId:
+                # the producer replaced the ring for larger frames
+                if ring is not None:
+                    ring.close()
+                ring = SharedFrameRing(ringPath)
+            image = ring.view(slot, generation, shape, np.dtype(dtype))
+            image.flags.writeable = False
+            result = functions[name](image, meta)
+            del image
+            if not ring.isValid(slot, generation):
+                raise StaleFrameError(f"slot {slot} was overwritten while {name} was running")
+            results.put((taskId, True, result))
+        except Exception as e:
+            results.put((taskId, False, f"{type(e).__name__}: {e}"))
+
+
+class AppRuntime:
+
+    def __init__(self, apps: Dict[str, Union[str, Callable, tuple]], workers: int = None,
+                 onResult: Callable = None, slots: int = None, block: bool = True,
+                 ringPath: str = None, maxRingBytes: int = 32 << 20) -> None:
+        # apps maps a name to the app or to (app, max concurrent frames). block makes the
+        # receiver wait for a free ring slot and app, otherwise frames arriving while every
+        # slot is in use or an app is at its limit are dropped. Without slots the ring gets
+        # as many slots as fit in maxRingBytes (at least 2), /dev/shm is 64M in docker
+        self.apps = {}
+        self.limits: Dict[str, asyncio.Semaphore] = {}
+        self.workers = workers or os.cpu_count() or 4
+        for name, app in apps.items():
+            app, limit = app if isinstance(app, tuple) else (app, self.workers)
+            self.apps[name] = app
+            self.limits[name] = asyncio.Semaphore(limit)
+        self.onResult = onResult
+        self.block = block
+        self.slots = slots
+        self.slotCount = slots or self.workers + 1
+        self.maxRingBytes = maxRingBytes
+        self.ringPath = ringPath or SharedFrameRing.pathForEndpoint(f"appruntime.{os.getpid()}")
+        self.ring: SharedFrameRing = None
+        self.freeSlots: asyncio.Queue = None
+        self.context = multiprocessing.get_context("spawn")
+        # SimpleQueue writes in the calling thread, a Queue feeder thread killed mid write by a
+        # crashing app would leave the shared lock held and hang the other workers
+        self.results = self.context.SimpleQueue()
+        self.processes: list = [None] * self.workers
+        self.taskQueues: list = [None] * self.workers
+        self.running: list = [dict() for _ in range(self.workers)]
+        self.tasks: Dict[int, tuple] = {}
+        self.taskIds = 0
+        self.frames: Dict[int, dict] = {}
+        self.sequence = 0
+        self.nextResult = 0
+        self.counts = {"frames": 0, "dropped": 0, "failed": 0, "restarts": 0}
+        self.loop: asyncio.AbstractEventLoop = None
+        self.collector: threading.Thread = None
+        self.watchdog: asyncio.Task = None
+        self.socket: SocketInterface = None
+
+    def startWorker(self, index: int) -> None:
+        tasks = self.context.Queue()
+        process = self.context.Process(target=workerMain, name=f"app-worker-{index}", daemon=True,
+                                       args=(index, self.apps, self.ringPath, tasks, self.results))
+        process.start()
+        self.processes[index] = process
+        self.taskQueues[index] = tasks
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.freeSlots = asyncio.Queue()
+        for slot in range(self.slotCount):
+            self.freeSlots.put_nowait(slot)
+        for index in range(self.workers):
+            self.startWorker(index)
+        self.collector = threading.Thread(target=self._collect, name="app-results", daemon=True)
+        self.collector.start()
+        self.watchdog = asyncio.create_task(self._watch())
+
+    def _collect(self) -> None:
+        while True:
+            item = self.results.get()
+            if item is None:
+                break
+            self.loop.call_soon_threadsafe(self._complete, *item)
+
+    async def _watch(self, interval: float = 0.5) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if process is None or process.is_alive():
+                    continue
+                logger.error(f"App worker {index} exited with {process.exitcode}, restarting")
+                self.counts["restarts"] += 1
+                crashed = list(self.running[index])
+                self.startWorker(index)
+                for taskId in crashed:
+                    self._complete(taskId, False, f"WorkerCrashed: exit code {process.exitcode}")
+
+    def pickWorker(self) -> int:
+        return min(range(self.workers), key=lambda index: len(self.running[index]))
+
+    async def submit(self, image: np.ndarray, meta: dict = None) -> Union[int, None]:
+        # copies the frame into the ring and starts every app on it, returns the
+        # frame sequence or None if the frame was dropped
+        if self.loop is None:
+            await self.start()
+        if not self.block and (self.freeSlots.empty() or any(limit.locked() for limit in self.limits.values())):
+            self.counts["dropped"] += 1
+            return None
+        slot = await self.freeSlots.get()
+        try:
+            if self.ring is not None and image.nbytes > self.ring.slotSize:
+                # write() would grow the ring on its own, past maxRingBytes and under the
+                # frames still being read. Resize once those are done, drop until then
+                if self.freeSlots.qsize() < self.slotCount - 1:
+                    logger.warning(f"Dropping frame of {image.nbytes} bytes until the ring can be resized")
+                    self.counts["dropped"] += 1
+                    self.freeSlots.put_nowait(slot)
+                    return None
+                logger.info(f"Resizing ring for frames of {image.nbytes} bytes")
+                self.ring.close()
+                self.ring = None
+            if self.ring is None:
+                slot = self.createRing(image.nbytes)
+            slot, generation = self.ring.write(np.ascontiguousarray(image), slot)
+        except SharedMemoryFull as e:
+            logger.error(f"Dropping frame, {e}. Lower slots or maxRingBytes or point IPC_SHM_DIR elsewhere")
+            self.counts["dropped"] += 1
+            self.freeSlots.put_nowait(slot)
+            return None
+        sequence = self.sequence
+        self.sequence += 1
+        self.counts["frames"] += 1
+        self.frames[sequence] = {"slot": slot, "meta": meta, "pending": len(self.apps), "results": {}}
+        for name in self.apps:
+            await self.limits[name].acquire()
+            taskId = self.taskIds
+            self.taskIds += 1
+            worker = self.pickWorker()
+            self.tasks[taskId] = (sequence, name, worker)
+            self.running[worker][taskId] = time.monotonic()
+            self.taskQueues[worker].put((taskId, name, slot, generation, self.ring.ringId,
+                                         image.shape, image.dtype.str, meta))
+        return sequence
+
+    def createRing(self, frameSize: int) -> int:
+        # sizes the ring for the first (or a larger) frame and returns the slot to write it
+        # to, no frame is in flight so the free slots are simply refilled
+        if self.slots is None:
+            self.slotCount = max(2, min(self.workers + 1, self.maxRingBytes // max(frameSize, 1)))
+        self.ring = SharedFrameRing(self.ringPath, self.slotCount, frameSize, create=True)
+        while not self.freeSlots.empty():
+            self.freeSlots.get_nowait()
+        for slot in range(1, self.slotCount):
+            self.freeSlots.put_nowait(slot)
+        return 0
+
+    def _complete(self, taskId: int, ok: bool, result) -> None:
+        task = self.tasks.pop(taskId, None)
+        if task is None:
+            # already reported as crashed
+            return
+        sequence, name, worker = task
+        self.running[worker].pop(taskId, None)
+        self.limits[name].release()
+        if not ok:
+            self.counts["failed"] += 1
+            logger.error(f"App {name} failed on frame {sequence}: {result}")
+            result = WorkerCrashed(result) if result.startswith("WorkerCrashed") else RuntimeError(result)
+        frame = self.frames[sequence]
+        frame["results"][name] = result
+        frame["pending"] -= 1
+        if frame["pending"] == 0:
+            self.freeSlots.put_nowait(frame["slot"])
+        self._deliver()
+
+    def _deliver(self) -> None:
+        # results leave in frame order, a slow frame holds back the ones after it
+        while self.nextResult in self.frames and self.frames[self.nextResult]["pending"] == 0:
+            frame = self.frames.pop(self.nextResult)
+            sequence = self.nextResult
+            self.nextResult += 1
+            if self.onResult is None:
+                continue
+            try:
+                result = self.onResult(sequence, frame["meta"], frame["results"])
+                if inspect.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception as e:
+                logger.error(f"onResult failed for frame {sequence}: {e}")
+
+    def callback(self, socket: SocketInterface) -> Callable:
+        # zmqloop callback feeding received frames to the runtime
+        async def onFrame(image_pack: dict) -> None:
+            image = socket.castImage(image_pack)
+            if image is None:
+                return
+            await self.submit(image, image_pack.get("meta"))
+        return onFrame
+
+    async def run(self, endpoint: str, bind: bool = False, type: zmq.SocketType = zmq.SocketType.SUB,
+                  **kwargs) -> None:
+        # the single reader of endpoint, zero copy since every frame is copied into the ring anyway
+        kwargs.setdefault("zeroCopy", True)
+        self.socket = SocketInterface(endpoint, bind=bind, type=type, **kwargs)
+        if type == zmq.SocketType.SUB:
+            self.socket.subscribe()
+        await self.start()
+        try:
+            await self.socket.zmqloop({"dataformat": self.callback(self.socket)})
+        finally:
+            await self.close()
+
+    async def drain(self, timeout: float = None) -> bool:
+        # waits until every submitted frame has been delivered
+        started = time.monotonic()
+        while self.frames:
+            if timeout is not None and time.monotonic() - started > timeout:
+                return False
+            await asyncio.sleep(0.01)
+        return True
+
+    def stats(self) -> dict:
+        return {**self.counts, "inFlight": len(self.frames),
+                "running": [len(running) for running in self.running]}
+
+    async def close(self) -> None:
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+            self.watchdog = None
+        for tasks in self.taskQueues:
+            if tasks is not None:
+                tasks.put(None)
+        for process in self.processes:
+            if process is not None:
+                await asyncio.get_running_loop().run_in_executor(None, process.join, 5)
+                if process.is_alive():
+                    process.terminate()
+        if self.collector is not None:
+            self.results.put(None)
+            self.collector.join()
+            self.collector = None
+        if self.socket is not None:
+            self.socket.close()
+        if self.ring is not None:
+            self.ring.close()
+            try:
+                os.remove(self.ringPath)
+            except OSError:
+                pass
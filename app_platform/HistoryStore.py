@@ -0,0 +1,333 @@
+# Indexed storage for inspection history images.
+#
+# Images are written as PNG into the history directory like before, every entry
+# also gets a JPEG thumbnail and a row in a SQLite index (history.db) with
+# timestamp, quality and result, so history views and exports query the index
+# instead of parsing app.csv and reading full size images. Writing happens on a
+# background thread in batches, the oldest entries are evicted once the directory
+# exceeds maxBytes.
+#
+#   store = HistoryStore("/history_images")
+#   await socket.zmqloop({"dataformat": store.callback(socket)})
+#   store.query(minQuality=3.5, limit=50)
+#
+#   python HistoryStore.py import /history_images/app.csv
+import csv
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Union
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp INTEGER NOT NULL,
+    quality REAL,
+    result TEXT,
+    image TEXT NOT NULL,
+    thumbnail TEXT,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    meta TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE INDEX IF NOT EXISTS entries_quality ON entries (quality);
+CREATE INDEX IF NOT EXISTS entries_result ON entries (result, timestamp);
+"""
+
+
+class HistoryStore:
+
+    def __init__(self, directory: str = None, maxBytes: int = None, thumbnailWidth: int = 256,
+                 batchSize: int = 32, maxPendingBytes: int = 128 << 20, flushInterval: float = 1.0) -> None:
+        if directory is None:
+            csvFile = os.environ.get("csv_file", "/history_images/app.csv")
+            directory = os.path.dirname(csvFile)
+        self.directory = directory
+        self.thumbnails = os.path.join(directory, "thumbnails")
+        os.makedirs(self.thumbnails, exist_ok=True)
+        self.maxBytes = maxBytes if maxBytes is not None else int(os.environ.get("HISTORY_MAX_BYTES", 2 << 30))
+        self.thumbnailWidth = thumbnailWidth
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.path = os.path.join(directory, "history.db")
+        self.db = self.connect()
+        self.db.executescript(SCHEMA)
+        self.totalBytes = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        self.writeLock = threading.Lock()
+        self.readLock = threading.Lock()
+        self.reader: sqlite3.Connection = None
+        # full resolution copies wait for the writer, the backlog is bounded by their size
+        self.pending = queue.Queue()
+        self.maxPendingBytes = maxPendingBytes
+        self.pendingBytes = 0
+        self.pendingLock = threading.Lock()
+        self.sequence = 0
+        self.counts = {"added": 0, "written": 0, "dropped": 0, "evicted": 0, "failed": 0}
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        # readers do not block the writer
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, image: np.ndarray, meta: dict = None, quality: float = None, result: str = None,
+            timestamp: int = None) -> bool:
+        # queues an entry, timestamp in epoch ms. False if the writer is too far behind
+        if not self.reserve(image.nbytes):
+            return False
+        self.enqueue(image, meta, quality, result, timestamp)
+        return True
+
+    def enqueue(self, image: np.ndarray, meta: dict, quality: float, result: str, timestamp: int) -> None:
+        # the image bytes have to be reserved
+        if timestamp is None:
+            dataformat = (meta or {}).get("dataformat", {})
+            timestamp = dataformat.get("timestamp") or int(time.time() * 1000)
+        self.pending.put((image, meta, quality, result, int(timestamp)))
+        self.counts["added"] += 1
+
+    def reserve(self, size: int) -> bool:
+        with self.pendingLock:
+            if self.pendingBytes + size > self.maxPendingBytes:
+                self.counts["dropped"] += 1
+                logger.warning("History writer behind, entry dropped")
+                return False
+            self.pendingBytes += size
+            return True
+
+    def release(self, size: int) -> None:
+        with self.pendingLock:
+            self.pendingBytes -= size
+
+    def callback(self, socket, key: str = "quality", resultKey: str = "json") -> Callable[[dict], None]:
+        # zmqloop callback storing every received result image. Quality and result are
+        # taken from the message or its meta, everything but the pixels ends up in meta
+        def onResult(image_pack: dict) -> None:
+            image = socket.castImage(image_pack)
+            if image is None:
+                return
+            # reserved before copying, a dropped entry costs no copy
+            if not self.reserve(image.nbytes):
+                return
+            if "shm" in image_pack or not image.flags.owndata:
+                # received buffers and shared memory slots are reused once the callback returns
+                image = np.array(image)
+            meta = {name: value for name, value in image_pack.items() if name not in ("data", "shm")}
+            fields = {**meta.get("meta", {}), **meta} if isinstance(meta.get("meta"), dict) else meta
+            quality = fields.get(key)
+            result = fields.get(resultKey)
+            self.enqueue(image, meta, quality if isinstance(quality, (int, float)) else None,
+                         None if result is None else str(result), None)
+        return onResult
+
+    def _run(self) -> None:
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flushInterval
+            while len(batch) < self.batchSize:
+                try:
+                    item = self.pending.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    break
+                batch.append(item)
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.counts["failed"] += len(batch)
+                logger.error(f"Failed to write history batch: {e}")
+            finally:
+                self.release(sum(entry[0].nbytes for entry in batch))
+            if item is None:
+                break
+
+    def filename(self, timestamp: int) -> str:
+        stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(timestamp / 1000))
+        while True:
+            name = f"image_{stamp}_{self.sequence}.png"
+            self.sequence += 1
+            if not os.path.exists(os.path.join(self.directory, name)):
+                return name
+
+    def thumbnail(self, image: np.ndarray, name: str) -> str:
+        rows, cols = image.shape[:2]
+        if cols > self.thumbnailWidth:
+            size = (self.thumbnailWidth, max(1, round(rows * self.thumbnailWidth / cols)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        thumbnail = os.path.splitext(name)[0] + ".jpg"
+        cv2.imwrite(os.path.join(self.thumbnails, thumbnail), image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        return thumbnail
+
+    def _write(self, batch: list) -> None:
+        rows = []
+        for image, meta, quality, result, timestamp in batch:
+            name = self.filename(timestamp)
+            path = os.path.join(self.directory, name)
+            # fast compression, the CPU is needed for inspection
+            if not cv2.imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+                self.counts["failed"] += 1
+                continue
+            thumbnail = self.thumbnail(image, name)
+            size = os.path.getsize(path) + os.path.getsize(os.path.join(self.thumbnails, thumbnail))
+            rows.append((timestamp, quality, result, name, thumbnail, size,
+                         json.dumps(meta, default=str) if meta is not None else None))
+        # imports share the connection with the writer thread
+        with self.writeLock:
+            self.insert(rows)
+            self.evict()
+        self.counts["written"] += len(rows)
+
+    def insert(self, rows: list) -> None:
+        with self.db:
+            self.db.executemany("INSERT INTO entries (timestamp, quality, result, image, thumbnail, bytes, meta) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.totalBytes += sum(row[5] for row in rows)
+
+    def evict(self) -> None:
+        # oldest entries go first until the store is below maxBytes again
+        while self.maxBytes and self.totalBytes > self.maxBytes:
+            oldest = self.db.execute("SELECT id, image, thumbnail, bytes FROM entries "
+                                     "ORDER BY timestamp, id LIMIT 64").fetchall()
+            if not oldest:
+                self.totalBytes = 0
+                break
+            removed = []
+            for entry in oldest:
+                for path in (os.path.join(self.directory, entry["image"]),
+                             os.path.join(self.thumbnails, entry["thumbnail"] or "")):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                removed.append(entry["id"])
+                self.totalBytes -= entry["bytes"]
+                if self.totalBytes <= self.maxBytes:
+                    break
+            with self.db:
+                self.db.executemany("DELETE FROM entries WHERE id = ?", [(id,) for id in removed])
+            self.counts["evicted"] += len(removed)
+
+    def read(self, sql: str, parameters: tuple = ()) -> list:
+        with self.readLock:
+            if self.reader is None:
+                self.reader = self.connect()
+            return self.reader.execute(sql, parameters).fetchall()
+
+    def query(self, start: int = None, end: int = None, minQuality: float = None, maxQuality: float = None,
+              result: str = None, limit: int = 100, offset: int = 0, newestFirst: bool = True) -> list:
+        # start / end in epoch ms, returns dicts without the meta blob
+        conditions, parameters = [], []
+        for condition, value in (("timestamp >= ?", start), ("timestamp < ?", end),
+                                 ("quality >= ?", minQuality), ("quality <= ?", maxQuality),
+                                 ("result = ?", result)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "DESC" if newestFirst else "ASC"
+        rows = self.read(f"SELECT id, timestamp, quality, result, image, thumbnail, bytes FROM entries {where} "
+                         f"ORDER BY timestamp {order}, id {order} LIMIT ? OFFSET ?", (*parameters, limit, offset))
+        return [dict(row) for row in rows]
+
+    def entry(self, id: int) -> Union[dict, None]:
+        rows = self.read("SELECT * FROM entries WHERE id = ?", (id,))
+        if not rows:
+            return None
+        entry = dict(rows[0])
+        entry["meta"] = json.loads(entry["meta"]) if entry["meta"] else None
+        return entry
+
+    def imagePath(self, entry: dict) -> str:
+        return os.path.join(self.directory, entry["image"])
+
+    def thumbnailPath(self, entry: dict) -> Union[str, None]:
+        return os.path.join(self.thumbnails, entry["thumbnail"]) if entry.get("thumbnail") else None
+
+    def count(self) -> int:
+        return self.read("SELECT COUNT(*) FROM entries")[0][0]
+
+    def importCsv(self, csvFile: str, thumbnails: bool = True) -> int:
+        # takes over an existing app.csv (image filename, JSON blob) without copying the images
+        known = {row[0] for row in self.read("SELECT image FROM entries")}
+        rows = []
+        with open(csvFile, newline="") as f:
+            for name, blob in csv.reader(f):
+                if name == "Column1" or name in known:
+                    continue
+                known.add(name)
+                path = os.path.join(self.directory, name)
+                try:
+                    meta = json.loads(blob)
+                except ValueError:
+                    meta = {"raw": blob}
+                timestamp = meta.get("dataformat", {}).get("timestamp")
+                if timestamp is None:
+                    timestamp = int(os.path.getmtime(path) * 1000) if os.path.exists(path) else 0
+                quality = meta.get("quality")
+                result = meta.get("json")
+                thumbnail = None
+                size = 0
+                if os.path.exists(path):
+                    size = os.path.getsize(path)
+                    image = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_4) if thumbnails else None
+                    if image is not None:
+                        thumbnail = self.thumbnail(image, name)
+                        size += os.path.getsize(os.path.join(self.thumbnails, thumbnail))
+                rows.append((int(timestamp), quality if isinstance(quality, (int, float)) else None,
+                             None if result is None else str(result), name, thumbnail, size, json.dumps(meta)))
+        with self.writeLock:
+            self.insert(rows)
+            self.evict()
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {**self.counts, "entries": self.count(), "bytes": self.totalBytes,
+                "maxBytes": self.maxBytes, "pending": self.pending.qsize(), "pendingBytes": self.pendingBytes}
+
+    def close(self) -> None:
+        self.pending.put(None)
+        self.thread.join()
+        if self.reader is not None:
+            self.reader.close()
+        self.db.close()
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["import", "stats"])
+    parser.add_argument("csv", nargs="?", help="app.csv to import, the images are expected next to it")
+    parser.add_argument("--directory")
+    parser.add_argument("--no-thumbnails", action="store_true")
+    args = parser.parse_args()
+    directory = args.directory or (os.path.dirname(os.path.abspath(args.csv)) if args.csv else None)
+    store = HistoryStore(directory)
+    try:
+        if args.command == "import":
+            imported = store.importCsv(args.csv, not args.no_thumbnails)
+            print(json.dumps({"imported": imported, **store.stats()}))
+        else:
+            print(json.dumps(store.stats()))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
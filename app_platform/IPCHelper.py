@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import logging.handlers
 import traceback
 import zmq
 import zmq.asyncio
@@ -10,12 +11,24 @@ from enum import IntEnum
 import cv2
 import json
 import inspect
-import queue
 import threading
+import heapq
+import itertools
+import concurrent.futures
+import bisect
+import weakref
+import hashlib
+import errno
+import queue
+from collections import deque
 import os
+import sys
 import logging
 import numpy as np
 import time
+import mmap
+import struct
+import re
 from typing import Callable, Dict, Union
 from Helpers.ImageHelper import ImageHelper
 from shared.BasicTypes import ParameterType
@@ -26,6 +39,106 @@ SocketCallback = Union[NoneResponse,Response]
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+
+def defaultMaxWidthJpg() -> int:
+    # CAMERA_MAX_WIDTH_JPG is only set in the camera container, everywhere else the
+    # liveview width of the camera applies as well
+    return int(os.environ.get("CAMERA_MAX_WIDTH_JPG", 1000))
+
+
+class IPCLogging:
+    # Logging of the per message hot path (received, sent, commands, answers).
+    #   "verbose"  logs every message, as before
+    #   "summary"  counts them and logs one line per endpoint and interval, every
+    #              sampleEvery-th message is still logged in full if set
+    # Endpoints in debugEndpoints log every message in both modes. The messages are
+    # %-style templates, arguments are only formatted for lines that are emitted.
+    # Configured by IPC_LOG_MODE, IPC_LOG_INTERVAL, IPC_LOG_SAMPLE and IPC_LOG_DEBUG
+    # (comma separated endpoints) or configure().
+    mode = os.environ.get("IPC_LOG_MODE", "verbose")
+    interval = float(os.environ.get("IPC_LOG_INTERVAL", 10))
+    sampleEvery = int(os.environ.get("IPC_LOG_SAMPLE", 0))
+    debugEndpoints = set(filter(None, os.environ.get("IPC_LOG_DEBUG", "").split(",")))
+    counts: Dict[tuple, int] = {}
+    lastSummary = time.monotonic()
+    listener: logging.handlers.QueueListener = None
+    # summaries are also written when an endpoint goes quiet
+    timer: threading.Thread = None
+    mutex = threading.Lock()
+
+    @classmethod
+    def configure(cls, mode: str = None, interval: float = None, sampleEvery: int = None,
+                  debugEndpoints: list = None, nonBlocking: bool = True, handlers: list = None) -> None:
+        # nonBlocking moves the handlers of this logger (or of the root logger) behind a
+        # QueueHandler, so the event loop never waits for stdout or journald
+        if mode is not None:
+            cls.mode = mode
+        if interval is not None:
+            cls.interval = interval
+        if sampleEvery is not None:
+            cls.sampleEvery = sampleEvery
+        if debugEndpoints is not None:
+            cls.debugEndpoints = set(debugEndpoints)
+        if nonBlocking and cls.listener is None:
+            if handlers is None:
+                handlers = logger.handlers or logging.getLogger().handlers or [logging.StreamHandler()]
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            sink = queue.SimpleQueue()
+            cls.listener = logging.handlers.QueueListener(sink, *handlers, respect_handler_level=True)
+            cls.listener.start()
+            logger.addHandler(logging.handlers.QueueHandler(sink))
+            logger.propagate = False
+
+    @classmethod
+    def stop(cls) -> None:
+        cls.flush()
+        if cls.listener is not None:
+            cls.listener.stop()
+            cls.listener = None
+
+    @classmethod
+    def event(cls, endpoint: str, message: str, *args) -> None:
+        if cls.mode == "verbose" or endpoint in cls.debugEndpoints:
+            logger.info(message, *args)
+            return
+        key = (endpoint, message)
+        with cls.mutex:
+            count = cls.counts.get(key, 0) + 1
+            cls.counts[key] = count
+        if cls.sampleEvery and (count - 1) % cls.sampleEvery == 0:
+            logger.info(message, *args)
+        if cls.timer is None:
+            cls.startTimer()
+
+    @classmethod
+    def startTimer(cls) -> None:
+        with cls.mutex:
+            if cls.timer is not None:
+                return
+            cls.timer = threading.Thread(target=cls._summarize, name="ipc-log-summary", daemon=True)
+        cls.timer.start()
+
+    @classmethod
+    def _summarize(cls) -> None:
+        while True:
+            time.sleep(max(cls.lastSummary + cls.interval - time.monotonic(), 0.05))
+            if time.monotonic() - cls.lastSummary >= cls.interval:
+                cls.flush()
+
+    @classmethod
+    def flush(cls) -> None:
+        now = time.monotonic()
+        with cls.mutex:
+            counts, cls.counts = cls.counts, {}
+        elapsed = now - cls.lastSummary
+        cls.lastSummary = now
+        endpoints: Dict[str, list] = {}
+        for (endpoint, message), count in counts.items():
+            endpoints.setdefault(endpoint, []).append(f"'{message}' x{count}")
+        for endpoint, lines in endpoints.items():
+            logger.info("%s: %s in %.1fs", endpoint, ", ".join(lines), elapsed)
+
 class CommandType(IntEnum):
 
     EXIT = 0
@@ -36,6 +149,951 @@ class CommandType(IntEnum):
     CAMERA_COMMAND = 5
 
 
+class FrameHeader:
+    # Versioned fixed layout header as alternative to the msgpack dataformat dict.
+    # Starts with MAGIC, which can never be the first byte of a msgpack map or
+    # json object, so receivers tell both forms apart from the first bytes.
+    # Only the free form meta is msgpack encoded, behind the fixed part.
+    MAGIC = b"IPCF"
+    VERSION = 1
+    # magic, version, format, dtype, flags, shape[3], strides[3], timestamp ms, frame id, sequence, meta length
+    layout = struct.Struct("<4sBBBB3I3qQQQI")
+    # ring id, slot, generation, path length
+    shmLayout = struct.Struct("<QIQH")
+    FLAG_META = 1
+    FLAG_SHM = 2
+    FORMATS = ["raw", "jpg", "both", "webp", "png"]
+    DTYPES = ["uint8", "uint16", "int16", "uint32", "int32", "float32", "float64", "int8"]
+
+    @classmethod
+    def isBinary(cls, header) -> bool:
+        return bytes(header[:4]) == cls.MAGIC
+
+    @classmethod
+    def pack(cls, format: str, shape: tuple, dtype="uint8", strides: tuple = None,
+             timestamp: int = 0, frameId: int = 0, sequence: int = 0,
+             meta: dict = None, shm: dict = None) -> bytes:
+        rows, cols = shape[0], shape[1]
+        channels = shape[2] if len(shape) > 2 else 1
+        dtype = np.dtype(dtype)
+        if strides is None:
+            strides = (cols * channels * dtype.itemsize, channels * dtype.itemsize, dtype.itemsize)
+        elif len(strides) == 2:
+            strides = (strides[0], strides[1], dtype.itemsize)
+        flags = 0
+        metaBytes = b""
+        if meta is not None:
+            flags |= cls.FLAG_META
+            metaBytes = msgpack.dumps(meta)
+        shmBytes = b""
+        if shm is not None:
+            flags |= cls.FLAG_SHM
+            path = shm["path"].encode()
+            shmBytes = cls.shmLayout.pack(shm["ring"], shm["slot"], shm["generation"], len(path)) + path
+        fixed = cls.layout.pack(cls.MAGIC, cls.VERSION, cls.FORMATS.index(format), cls.DTYPES.index(dtype.name),
+                                flags, rows, cols, channels, *strides, timestamp, frameId, sequence, len(metaBytes))
+        return fixed + shmBytes + metaBytes
+
+    @classmethod
+    def unpack(cls, header) -> dict:
+        (magic, version, format, dtype, flags, rows, cols, channels, rowStride, colStride, channelStride,
+         timestamp, frameId, sequence, metaLength) = cls.layout.unpack_from(header, 0)
+        if version != cls.VERSION:
+            raise ValueError(f"unsupported frame header version {version}")
+        dataformat = {"type": cls.FORMATS[format], "rows": rows, "cols": cols, "channels": channels,
+                      "dtype": cls.DTYPES[dtype], "strides": [rowStride, colStride, channelStride],
+                      "frameId": frameId, "sequence": sequence}
+        if timestamp:
+            dataformat["timestamp"] = timestamp
+        message = {"dataformat": dataformat}
+        offset = cls.layout.size
+        if flags & cls.FLAG_SHM:
+            ring, slot, generation, pathLength = cls.shmLayout.unpack_from(header, offset)
+            offset += cls.shmLayout.size
+            path = bytes(header[offset:offset + pathLength]).decode()
+            offset += pathLength
+            message["shm"] = {"path": path, "ring": ring, "slot": slot, "generation": generation}
+        if flags & cls.FLAG_META:
+            message["meta"] = msgpack.unpackb(header[offset:offset + metaLength], strict_map_key=False,
+                                              raw=False, use_list=True)
+        return message
+
+
+def frameArray(data, dataformat: dict) -> np.ndarray:
+    # builds the image array on the received buffer, honouring dtype and row padding
+    rows, cols, channels = itemgetter('rows', 'cols', 'channels')(dataformat)
+    dtype = np.dtype(dataformat.get("dtype", "uint8"))
+    strides = dataformat.get("strides")
+    if isinstance(data, np.ndarray) and data.dtype == dtype and data.shape == (rows, cols, channels):
+        return data
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if strides is None or tuple(strides) == (cols * channels * dtype.itemsize, channels * dtype.itemsize, dtype.itemsize):
+        return buffer.view(dtype).reshape((rows, cols, channels))
+    return np.ndarray((rows, cols, channels), dtype=dtype, buffer=buffer, strides=tuple(strides))
+
+
+class FrameView:
+    # The part of a frame a consumer needs: roi (x, y, width, height) in full frame
+    # pixels, step keeps every step-th pixel and scale (< 1) resizes the region.
+    # Raw frames are cut out of the received buffer as strided views, only scale,
+    # grayscale or copy make a (small) copy. JPEGs are decoded at the largest libjpeg
+    # reduction the view allows, the full resolution image is never built.
+    #
+    #   @FrameView(roi=(100, 200, 640, 480), step=2)
+    #   def onFrame(image_pack): image_pack["image"] ...
+
+    def __init__(self, roi: tuple = None, step: int = 1, scale: float = 1.0,
+                 grayscale: bool = False, copy: bool = False) -> None:
+        self.roi = tuple(roi) if roi is not None else None
+        self.step = max(int(step), 1)
+        self.scale = min(float(scale), 1.0)
+        self.grayscale = grayscale
+        self.copy = copy
+
+    def __call__(self, fn: SocketCallback) -> SocketCallback:
+        # used as decorator, zmqloop hands the callback image_pack["image"] with this view
+        fn.frameView = self
+        return fn
+
+    @classmethod
+    def fromEnvironment(cls, name: str = "CAMERA_FORCE_ROI", **kwargs) -> "FrameView":
+        # "x,y,width,height", OFF for the full frame
+        value = os.environ.get(name, "OFF").strip()
+        roi = None
+        if value.upper() not in ("", "OFF", "FALSE", "0"):
+            roi = tuple(int(part) for part in re.split(r"[,; ]+", value))
+        return cls(roi, **kwargs)
+
+    @property
+    def factor(self) -> float:
+        return self.step / self.scale
+
+    def reduction(self) -> int:
+        # libjpeg can decode at 1/2, 1/4 and 1/8 of the resolution
+        for reduce in (8, 4, 2):
+            if reduce <= self.factor:
+                return reduce
+        return 1
+
+    def region(self, rows: int, cols: int, reduce: int = 1) -> tuple[slice, slice]:
+        if self.roi is None:
+            return slice(0, rows), slice(0, cols)
+        x, y, width, height = (value // reduce for value in self.roi)
+        x, y = min(max(x, 0), cols), min(max(y, 0), rows)
+        return slice(y, min(y + max(height, 1), rows)), slice(x, min(x + max(width, 1), cols))
+
+    def applyArray(self, image: np.ndarray, reduce: int = 1) -> np.ndarray:
+        # image is the (already reduced by reduce) full frame, usually a view
+        rows, cols = image.shape[:2]
+        ySlice, xSlice = self.region(rows, cols, reduce)
+        factor = self.factor / reduce
+        if self.scale == 1.0 and factor == int(factor):
+            view = image[ySlice.start:ySlice.stop:int(factor), xSlice.start:xSlice.stop:int(factor)]
+        else:
+            view = image[ySlice, xSlice]
+            size = (max(round(view.shape[1] / factor), 1), max(round(view.shape[0] / factor), 1))
+            if size != (view.shape[1], view.shape[0]):
+                view = cv2.resize(view, size, interpolation=cv2.INTER_AREA)
+        if self.grayscale and view.ndim == 3 and view.shape[2] == 3:
+            view = cv2.cvtColor(view, cv2.COLOR_BGR2GRAY)
+        if self.copy:
+            view = np.ascontiguousarray(view)
+        return view
+
+    def apply(self, data, dataformat: dict) -> np.ndarray:
+        if dataformat.get("type") in FrameCodec.ENCODED:
+            reduce = self.reduction()
+            image = FrameCodec.default().decodeSync(data, reduce, self.grayscale)
+            return self.applyArray(image, reduce)
+        return self.applyArray(frameArray(data, dataformat))
+
+
+class DumpWriter:
+    # Keeps undecodable or failing messages for analysis without writing on the event
+    # loop. record() only does bookkeeping: the last failures stay in a bounded ring,
+    # repeated error signatures are deduplicated, bursts are rate limited and the
+    # files are written by a background thread. Payloads of messages above maxBytes
+    # are not even queued, only their sizes are stored; the header frame is always kept.
+    shared = None
+
+    def __init__(self, directory: str = None, ringSize: int = 32, maxFiles: int = 64,
+                 ratePerMinute: int = 10, dedupeWindow: float = 60.0, maxBytes: int = 1 << 20) -> None:
+        if directory is None:
+            directory = os.environ.get("IPC_DUMP_DIR", "/dump" if os.path.isdir("/dump") else os.getcwd())
+        self.directory = directory
+        self.recent = deque(maxlen=ringSize)
+        self.maxFiles = maxFiles
+        self.ratePerMinute = ratePerMinute
+        self.dedupeWindow = dedupeWindow
+        self.maxBytes = maxBytes
+        self.signatures: Dict[str, float] = {}
+        self.tokens = float(ratePerMinute)
+        self.refilled = time.monotonic()
+        self.written = deque()
+        self.pending = queue.Queue(maxsize=ringSize)
+        self.thread: threading.Thread = None
+        self.mutex = threading.Lock()
+        self.counts = {"recorded": 0, "duplicates": 0, "rateLimited": 0, "queueFull": 0, "written": 0, "failed": 0}
+
+    @classmethod
+    def default(cls) -> "DumpWriter":
+        if cls.shared is None:
+            cls.shared = cls()
+        return cls.shared
+
+    def _allow(self, signature: str, now: float) -> bool:
+        last = self.signatures.get(signature)
+        if last is not None and now - last < self.dedupeWindow:
+            self.counts["duplicates"] += 1
+            return False
+        self.tokens = min(self.ratePerMinute, self.tokens + (now - self.refilled) * self.ratePerMinute / 60.0)
+        self.refilled = now
+        if self.tokens < 1:
+            self.counts["rateLimited"] += 1
+            return False
+        self.tokens -= 1
+        self.signatures[signature] = now
+        if len(self.signatures) > 256:
+            self.signatures = {key: seen for key, seen in self.signatures.items() if now - seen < self.dedupeWindow}
+        return True
+
+    def record(self, kind: str, messages: list, error: Exception, endpoint: str = "") -> bool:
+        # returns True if the message will be written
+        parts = messages if isinstance(messages, list) else [messages]
+        sizes = [memoryview(part).nbytes for part in parts]
+        signature = f"{kind}:{type(error).__name__}:{str(error)[:80]}:{sizes[0] if sizes else 0}"
+        entry = {"time": time.time(), "endpoint": endpoint, "kind": kind,
+                 "error": f"{type(error).__name__}: {error}", "signature": signature, "sizes": sizes}
+        with self.mutex:
+            self.counts["recorded"] += 1
+            self.recent.append(entry)
+            if not self._allow(signature, time.monotonic()):
+                return False
+        if sum(sizes) > self.maxBytes:
+            # a full resolution frame must not wait in memory for the writer
+            parts = parts[:1]
+        try:
+            self.pending.put_nowait((entry, parts))
+        except queue.Full:
+            self.counts["queueFull"] += 1
+            return False
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="dump-writer", daemon=True)
+            self.thread.start()
+        return True
+
+    def _run(self) -> None:
+        while True:
+            entry, parts = self.pending.get()
+            try:
+                self._write(entry, parts)
+                self.counts["written"] += 1
+            except Exception as e:
+                self.counts["failed"] += 1
+                logger.error(f"Failed to write dump: {e}")
+
+    def _write(self, entry: dict, parts: list) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(entry["time"]))
+        digest = hashlib.sha1(entry["signature"].encode()).hexdigest()[:8]
+        base = os.path.join(self.directory, f"{entry['kind']}_{stamp}_{digest}")
+        files = []
+        # record() only queues the payloads of messages up to maxBytes, sha1 is None for the others
+        entry["sha1"] = [None] * len(entry["sizes"])
+        for index, part in enumerate(parts):
+            entry["sha1"][index] = hashlib.sha1(part).hexdigest()
+            path = base + (".bin" if index == 0 else f".part{index}.bin")
+            with open(path, "wb") as f:
+                f.write(part)
+            files.append(path)
+        entry["files"] = [os.path.basename(path) for path in files]
+        with open(os.path.join(self.directory, "dumps.jsonl"), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.written.extend(files)
+        while len(self.written) > self.maxFiles:
+            try:
+                os.remove(self.written.popleft())
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return dict(self.counts, recent=list(self.recent))
+
+
+class StaleFrameError(Exception):
+    pass
+
+
+class SharedMemoryFull(Exception):
+    pass
+
+
+class SharedRingUnavailable(StaleFrameError):
+    # the ring of a frame cannot be opened, e.g. IPC_SHM_DIR is not shared between the containers
+    pass
+
+
+class SharedFrameRing:
+    # Ring of fixed size frame slots in a memory mapped file. The producer
+    # copies each frame into the next slot and only the slot index and
+    # generation travel over zeromq. A generation is odd while the slot is
+    # being written, readers compare it to detect overwritten frames.
+    MAGIC = b"IPCSHM01"
+    VERSION = 1
+    PAGE = 4096
+    fileHeader = struct.Struct("<8sIIQQ")  # magic, version, slotCount, slotSize, ringId
+
+    def __init__(self, path: str, slotCount: int = 4, slotSize: int = 0, create: bool = False) -> None:
+        self.path = path
+        self.slotCount = slotCount
+        self.slotSize = slotSize
+        self.nextSlot = 0
+        self.mm = None
+        self.ringId = 0
+        if create:
+            self.create(slotSize)
+        else:
+            self.open()
+
+    @staticmethod
+    def pathForEndpoint(endpoint: str) -> str:
+        # not next to the ipc socket, /signals is a small tmpfs. IPC_SHM_DIR has to be
+        # shared between the containers of sender and receiver
+        directory = os.environ.get("IPC_SHM_DIR", "/dev/shm")
+        if endpoint.startswith("ipc://"):
+            endpoint = endpoint[6:]
+        return os.path.join(directory, "ipc_" + re.sub(r"[^A-Za-z0-9_.-]", "_", endpoint.strip("/")) + ".shm")
+
+    def _layout(self) -> None:
+        tableSize = self.fileHeader.size + self.slotCount * 16
+        self.dataOffset = (tableSize + self.PAGE - 1) // self.PAGE * self.PAGE
+        self.generations = np.ndarray((self.slotCount,), dtype=np.uint64, buffer=self.mm,
+                                      offset=self.fileHeader.size)
+        self.sizes = np.ndarray((self.slotCount,), dtype=np.uint64, buffer=self.mm,
+                                offset=self.fileHeader.size + self.slotCount * 8)
+
+    def create(self, slotSize: int) -> None:
+        self.close()
+        self.slotSize = (max(slotSize, 1) + self.PAGE - 1) // self.PAGE * self.PAGE
+        self.ringId = int.from_bytes(os.urandom(8), "little") or 1
+        tableSize = self.fileHeader.size + self.slotCount * 16
+        dataOffset = (tableSize + self.PAGE - 1) // self.PAGE * self.PAGE
+        totalSize = dataOffset + self.slotCount * self.slotSize
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # write a new inode so readers still mapping the old ring stay valid
+        tmpPath = self.path + ".tmp"
+        fd = os.open(tmpPath, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o666)
+        try:
+            # reserve the pages, a sparse file on a full tmpfs fails with SIGBUS on the first write
+            try:
+                os.posix_fallocate(fd, 0, totalSize)
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    os.close(fd)
+                    fd = None
+                    os.remove(tmpPath)
+                    raise SharedMemoryFull(f"no room for {totalSize} bytes in {directory}: {e}") from e
+                os.ftruncate(fd, totalSize)
+            self.mm = mmap.mmap(fd, totalSize, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        self.fileHeader.pack_into(self.mm, 0, self.MAGIC, self.VERSION, self.slotCount, self.slotSize, self.ringId)
+        os.chmod(tmpPath, 0o0666)
+        os.replace(tmpPath, self.path)
+        self.writable = True
+        self._layout()
+
+    def open(self) -> None:
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            self.mm = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, version, self.slotCount, self.slotSize, self.ringId = self.fileHeader.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"{self.path} is not a shared frame ring")
+        self.writable = False
+        self._layout()
+
+    def close(self) -> None:
+        if self.mm is not None:
+            self.generations = None
+            self.sizes = None
+            try:
+                self.mm.close()
+            except BufferError:
+                # numpy views handed out to callbacks still reference the mapping,
+                # it is released once the last view is gone
+                pass
+            self.mm = None
+
+    def write(self, image: np.ndarray, slot: int = None) -> tuple[int, int]:
+        # slot overrides the round robin order, for producers tracking which slots are still read
+        if self.mm is None or image.nbytes > self.slotSize:
+            self.create(image.nbytes)
+        if slot is None:
+            slot = self.nextSlot
+        self.nextSlot = (slot + 1) % self.slotCount
+        generation = int(self.generations[slot]) + 1
+        self.generations[slot] = generation
+        target = np.ndarray(image.shape, dtype=image.dtype, buffer=self.mm,
+                            offset=self.dataOffset + slot * self.slotSize)
+        np.copyto(target, image)
+        self.sizes[slot] = image.nbytes
+        generation += 1
+        self.generations[slot] = generation
+        return slot, generation
+
+    def isValid(self, slot: int, generation: int) -> bool:
+        return self.mm is not None and int(self.generations[slot]) == generation
+
+    def view(self, slot: int, generation: int, shape: tuple, dtype=np.uint8) -> np.ndarray:
+        if not self.isValid(slot, generation):
+            raise StaleFrameError(f"slot {slot} of {self.path} was overwritten")
+        return np.ndarray(shape, dtype=dtype, buffer=self.mm, offset=self.dataOffset + slot * self.slotSize)
+
+
+class LatencyHistogram:
+    # fixed log scale buckets from 50 us to ~1.6 s, cheap enough for every message
+    BOUNDS = [50e-6 * 2 ** i for i in range(16)]
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99)}
+
+
+class IPCMetrics:
+    # Counters and latency histograms of one SocketInterface. Stages of a received
+    # message: age (camera timestamp to receipt, if the sender sets one), recv (read
+    # off the socket until unpacking starts), unpack, callback, reply and total.
+    # Sent messages record queue (waiting in the send queue) and send.
+    registry = weakref.WeakSet()
+    STAGES = ("age", "recv", "unpack", "callback", "reply", "total", "queue", "send")
+    # rates cover about the last RATE_WINDOW seconds, sampled at most once a second
+    RATE_WINDOW = 10.0
+
+    def __init__(self, endpoint: str, id: int = -1) -> None:
+        self.endpoint = endpoint
+        self.id = id
+        self.started = time.time()
+        self.messagesIn = 0
+        self.bytesIn = 0
+        self.messagesOut = 0
+        self.bytesOut = 0
+        self.reconnects = 0
+        self.stages = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.keys: Dict[str, dict] = {}
+        self.gauges: Dict[str, Callable[[], int]] = {}
+        self.rateSamples = deque([(time.monotonic(), 0, 0, 0, 0)])
+        IPCMetrics.registry.add(self)
+
+    def received(self, size: int) -> None:
+        self.messagesIn += 1
+        self.bytesIn += size
+
+    def sent(self, size: int) -> None:
+        self.messagesOut += 1
+        self.bytesOut += size
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self.stages[stage].observe(seconds)
+
+    def observeKey(self, key: str, seconds: float, size: int) -> None:
+        entry = self.keys.get(key)
+        if entry is None:
+            entry = self.keys[key] = {"messages": 0, "bytes": 0, "callback": LatencyHistogram()}
+        entry["messages"] += 1
+        entry["bytes"] += size
+        entry["callback"].observe(seconds)
+
+    def rates(self) -> dict:
+        # rates over the last RATE_WINDOW seconds (since start before that). Independent of
+        # how often and by how many readers it is called, the UI and a scraper see the same
+        now = time.monotonic()
+        samples = self.rateSamples
+        if now - samples[-1][0] >= 1.0:
+            samples.append((now, self.messagesIn, self.bytesIn, self.messagesOut, self.bytesOut))
+        while len(samples) > 1 and now - samples[1][0] >= self.RATE_WINDOW:
+            samples.popleft()
+        then, messagesIn, bytesIn, messagesOut, bytesOut = samples[0]
+        elapsed = max(now - then, 1e-9)
+        return {"messagesIn": (self.messagesIn - messagesIn) / elapsed,
+                "bytesIn": (self.bytesIn - bytesIn) / elapsed,
+                "messagesOut": (self.messagesOut - messagesOut) / elapsed,
+                "bytesOut": (self.bytesOut - bytesOut) / elapsed}
+
+    def snapshot(self) -> dict:
+        return {"endpoint": self.endpoint, "id": self.id,
+                "uptime": time.time() - self.started,
+                "messagesIn": self.messagesIn, "bytesIn": self.bytesIn,
+                "messagesOut": self.messagesOut, "bytesOut": self.bytesOut,
+                "reconnects": self.reconnects,
+                "perSecond": self.rates(),
+                "gauges": {name: gauge() for name, gauge in self.gauges.items()},
+                "stages": {stage: histogram.snapshot() for stage, histogram in self.stages.items() if histogram.count},
+                "keys": {key: {"messages": entry["messages"], "bytes": entry["bytes"],
+                               "callback": entry["callback"].snapshot()} for key, entry in self.keys.items()}}
+
+    @classmethod
+    def dumpJson(cls) -> str:
+        return json.dumps([metrics.snapshot() for metrics in list(cls.registry)])
+
+    @classmethod
+    def dumpPrometheus(cls) -> str:
+        lines = []
+
+        def histogram(name: str, labels: str, hist: LatencyHistogram) -> None:
+            cumulative = 0
+            for bound, count in zip(LatencyHistogram.BOUNDS, hist.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound:.6f}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+            lines.append(f'{name}_sum{{{labels}}} {hist.sum}')
+            lines.append(f'{name}_count{{{labels}}} {hist.count}')
+
+        # the text format wants all samples of a metric in one group, so families come first
+        instances = [(metrics, f'endpoint="{metrics.endpoint}",id="{metrics.id}"') for metrics in list(cls.registry)]
+        lines.append("# TYPE ipc_messages_total counter")
+        for metrics, labels in instances:
+            lines.append(f'ipc_messages_total{{{labels},direction="in"}} {metrics.messagesIn}')
+            lines.append(f'ipc_messages_total{{{labels},direction="out"}} {metrics.messagesOut}')
+        lines.append("# TYPE ipc_bytes_total counter")
+        for metrics, labels in instances:
+            lines.append(f'ipc_bytes_total{{{labels},direction="in"}} {metrics.bytesIn}')
+            lines.append(f'ipc_bytes_total{{{labels},direction="out"}} {metrics.bytesOut}')
+        lines.append("# TYPE ipc_reconnects_total counter")
+        for metrics, labels in instances:
+            lines.append(f'ipc_reconnects_total{{{labels}}} {metrics.reconnects}')
+        gauges = sorted({name for metrics, _ in instances for name in metrics.gauges})
+        for name in gauges:
+            lines.append(f"# TYPE ipc_{name} gauge")
+            for metrics, labels in instances:
+                gauge = metrics.gauges.get(name)
+                if gauge is not None:
+                    lines.append(f'ipc_{name}{{{labels}}} {gauge()}')
+        lines.append("# TYPE ipc_stage_seconds histogram")
+        for metrics, labels in instances:
+            for stage, hist in metrics.stages.items():
+                if hist.count:
+                    histogram("ipc_stage_seconds", f'{labels},stage="{stage}"', hist)
+        lines.append("# TYPE ipc_callback_seconds histogram")
+        for metrics, labels in instances:
+            for key, entry in metrics.keys.items():
+                histogram("ipc_callback_seconds", f'{labels},key="{key}"', entry["callback"])
+        return "\n".join(lines) + "\n"
+
+
+class SendPolicy(IntEnum):
+    # what happens to a message that does not fit into a full send queue
+    BLOCK = 0        # wait for room, nothing is dropped (trigger images)
+    DROP_OLDEST = 1  # evict the oldest droppable queued message
+    DROP_NEWEST = 2  # drop the message being enqueued
+    LATEST = 3       # keep only the newest message of this priority (liveview), it always
+                     # gets its one slot and never waits for or loses against other prios
+
+
+class MessageDropped(Exception):
+    pass
+
+
+def messageSize(message) -> int:
+    if isinstance(message, list):
+        return sum(memoryview(part).nbytes for part in message)
+    return memoryview(message).nbytes
+
+
+class SendScheduler:
+    # Priority send queue drained by a single coroutine. Lower prio values are sent
+    # first, messages with equal prio keep their order. The coroutine runs on the
+    # event loop of the first submitter, or on an own I/O thread when started from
+    # outside a loop. Submitting is thread safe and never blocks the event loop,
+    # every submit returns a future that completes with the reply (or None).
+
+    def __init__(self, sendFn: Callable, name: str = "",
+                 maxDepth: int = 0, maxBytes: int = 0,
+                 policy: SendPolicy = SendPolicy.BLOCK, policies: Dict[int, SendPolicy] = None) -> None:
+        self.sendFn = sendFn
+        self.name = name
+        self.heap = []
+        self.counter = itertools.count()
+        self.mutex = threading.Lock()
+        # backpressure, 0 means unbounded. policies overrides policy per priority
+        self.maxDepth = maxDepth
+        self.maxBytes = maxBytes
+        self.policy = policy
+        self.policies = dict(policies) if policies is not None else {}
+        self.space = threading.Condition(self.mutex)
+        self.spaceWaiters = []
+        self.queuedBytes = 0
+        self.dropped: Dict[int, int] = {}
+        self.droppedBytes = 0
+        self.overBudget = 0
+        self.loop: asyncio.AbstractEventLoop = None
+        self.thread: threading.Thread = None
+        self.task: asyncio.Task = None
+        self.wakeup: asyncio.Event = None
+        self.closed = False
+        self.metrics: IPCMetrics = None
+
+    def start(self, useThread: bool = None) -> None:
+        if self.loop is not None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if useThread or (useThread is None and running is None):
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self._runThread, name=f"send-{self.name}", daemon=True)
+            self.thread.start()
+        else:
+            if running is None:
+                raise RuntimeError("SendScheduler on the caller loop needs a running event loop")
+            self.loop = running
+            self.task = running.create_task(self.run())
+
+    def _runThread(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.run())
+        finally:
+            self.loop.close()
+
+    def onLoop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _wake(self) -> None:
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _notify(self) -> None:
+        if self.onLoop():
+            self._wake()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def qsize(self) -> int:
+        return len(self.heap)
+
+    def stats(self) -> dict:
+        with self.mutex:
+            return {"depth": len(self.heap), "bytes": self.queuedBytes,
+                    "dropped": dict(self.dropped), "droppedBytes": self.droppedBytes,
+                    "overBudget": self.overBudget}
+
+    def policyFor(self, prio: int, policy: SendPolicy = None) -> SendPolicy:
+        if policy is not None:
+            return policy
+        return self.policies.get(prio, self.policy)
+
+    def _full(self, size: int) -> bool:
+        if self.maxDepth and len(self.heap) >= self.maxDepth:
+            return True
+        # a single message above the byte budget still passes an empty queue
+        return bool(self.maxBytes and self.heap and self.queuedBytes + size > self.maxBytes)
+
+    def _remove(self, index: int, droppedFutures: list) -> None:
+        item = self.heap[index]
+        self.heap[index] = self.heap[-1]
+        self.heap.pop()
+        heapq.heapify(self.heap)
+        self._drop(item, droppedFutures)
+
+    def _drop(self, item: tuple, droppedFutures: list) -> None:
+        self.queuedBytes -= item[4]
+        self._countDrop(item[0], item[4])
+        droppedFutures.append(item[3])
+
+    def _countDrop(self, prio: int, size: int) -> None:
+        self.dropped[prio] = self.dropped.get(prio, 0) + 1
+        self.droppedBytes += size
+
+    def _offer(self, prio: int, message, size: int, future, policy: SendPolicy, droppedFutures: list):
+        # called with the mutex held. True when queued, False when dropped,
+        # None when the queue is full and the message has to wait
+        if policy == SendPolicy.LATEST:
+            # replaces the queued messages of this prio, except those queued with BLOCK
+            stale = [item for item in self.heap if item[0] == prio and item[5] != SendPolicy.BLOCK]
+            if stale:
+                self.heap = [item for item in self.heap if item[0] != prio or item[5] == SendPolicy.BLOCK]
+                heapq.heapify(self.heap)
+                for item in stale:
+                    self._drop(item, droppedFutures)
+            # queued even when BLOCK frames fill the budget, otherwise liveview is lost
+            # exactly while there is backpressure
+            if self._full(size):
+                self.overBudget += 1
+            self._push(prio, message, size, future, policy)
+            return True
+        if self._full(size) and policy == SendPolicy.DROP_OLDEST:
+            while self._full(size):
+                candidates = [index for index, item in enumerate(self.heap) if item[5] != SendPolicy.BLOCK]
+                if not candidates:
+                    break
+                self._remove(min(candidates, key=lambda index: self.heap[index][1]), droppedFutures)
+        if self._full(size):
+            if policy == SendPolicy.BLOCK:
+                return None
+            self._countDrop(prio, size)
+            droppedFutures.append(future)
+            return False
+        self._push(prio, message, size, future, policy)
+        return True
+
+    def _push(self, prio: int, message, size: int, future, policy: SendPolicy) -> None:
+        heapq.heappush(self.heap, (prio, next(self.counter), message, future, size, policy, time.perf_counter()))
+        self.queuedBytes += size
+
+    def _resolveDropped(self, droppedFutures: list) -> None:
+        for future in droppedFutures:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(MessageDropped(f"send queue {self.name} is full"))
+
+    def _newFuture(self, event: asyncio.Event = None) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        if event is not None:
+            try:
+                callerLoop = asyncio.get_running_loop()
+            except RuntimeError:
+                callerLoop = None
+            if callerLoop is None:
+                future.add_done_callback(lambda f: event.set())
+            else:
+                future.add_done_callback(lambda f: callerLoop.call_soon_threadsafe(event.set))
+        return future
+
+    def submit(self, message, prio: int = 1, event: asyncio.Event = None,
+               policy: SendPolicy = None) -> concurrent.futures.Future:
+        # with BLOCK a full queue blocks the calling thread, on the scheduler's own
+        # loop that is impossible and the message is queued over budget instead
+        if self.closed:
+            raise RuntimeError("SendScheduler is stopped")
+        self.start()
+        future = self._newFuture(event)
+        size = messageSize(message)
+        policy = self.policyFor(prio, policy)
+        droppedFutures = []
+        onLoop = self.onLoop()
+        with self.space:
+            while self._offer(prio, message, size, future, policy, droppedFutures) is None:
+                if onLoop or self.thread is threading.current_thread():
+                    self._push(prio, message, size, future, policy)
+                    self.overBudget += 1
+                    break
+                self.space.wait()
+        self._resolveDropped(droppedFutures)
+        self._notify()
+        return future
+
+    async def submitWait(self, message, prio: int = 1, event: asyncio.Event = None,
+                         policy: SendPolicy = None) -> concurrent.futures.Future:
+        # like submit, but waits for room without blocking the event loop.
+        # returns the completion future once the message is queued or dropped
+        if self.closed:
+            raise RuntimeError("SendScheduler is stopped")
+        self.start()
+        future = self._newFuture(event)
+        size = messageSize(message)
+        policy = self.policyFor(prio, policy)
+        loop = asyncio.get_running_loop()
+        while True:
+            droppedFutures = []
+            with self.mutex:
+                offered = self._offer(prio, message, size, future, policy, droppedFutures)
+                if offered is None:
+                    waiter = loop.create_future()
+                    self.spaceWaiters.append((loop, waiter))
+            self._resolveDropped(droppedFutures)
+            if offered is not None:
+                break
+            await waiter
+        self._notify()
+        return future
+
+    async def put(self, message, prio: int = 1, policy: SendPolicy = None):
+        return await asyncio.wrap_future(await self.submitWait(message, prio, policy=policy))
+
+    def _pop(self):
+        with self.mutex:
+            if not self.heap:
+                return None
+            item = heapq.heappop(self.heap)
+            self.queuedBytes -= item[4]
+            self.space.notify_all()
+            waiters, self.spaceWaiters = self.spaceWaiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+        return item
+
+    async def _send(self, message):
+        # sendFn may be a WeakMethod so the queue does not keep its socket alive
+        sendFn = self.sendFn() if isinstance(self.sendFn, weakref.WeakMethod) else self.sendFn
+        if sendFn is None:
+            raise RuntimeError("send target is gone")
+        return await sendFn(message)
+
+    async def run(self) -> None:
+        self.wakeup = asyncio.Event()
+        while not self.closed:
+            self.wakeup.clear()
+            item = self._pop()
+            if item is None:
+                await self.wakeup.wait()
+                continue
+            future = item[3]
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self.metrics is not None:
+                self.metrics.observe("queue", time.perf_counter() - item[6])
+            try:
+                reply = await self._send(item[2])
+            except asyncio.CancelledError:
+                future.set_exception(concurrent.futures.CancelledError())
+                raise
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(reply)
+        self._cancelPending()
+
+    def _cancelPending(self) -> None:
+        with self.mutex:
+            pending, self.heap = self.heap, []
+            self.queuedBytes = 0
+            self.space.notify_all()
+        for item in pending:
+            item[3].cancel()
+
+    def stop(self) -> None:
+        self.closed = True
+        if self.loop is None:
+            return
+        self._notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+
+class FrameCodec:
+    # JPEG encoding and decoding on a thread pool. imencode, imdecode and resize
+    # release the GIL, so the workers use all cores without blocking acquisition
+    # or the event loop. Downscaling before encoding reuses a per thread buffer.
+    REDUCED_COLOR = {1: cv2.IMREAD_ANYCOLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                     4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+    REDUCED_GRAYSCALE = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                         4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+    # dataformat types carrying an encoded image
+    ENCODED = ("jpg", "webp", "png")
+    shared = None
+
+    def __init__(self, workers: int = None, quality: int = None, maxWidth: int = None) -> None:
+        self.workers = workers or os.cpu_count() or 4
+        self.quality = quality if quality is not None else int(os.environ.get("CAMERA_JPG_QUALITY", 90))
+        self.maxWidth = maxWidth if maxWidth is not None else defaultMaxWidthJpg()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="codec")
+        self.buffers = threading.local()
+
+    @classmethod
+    def default(cls) -> "FrameCodec":
+        # one pool per process shared by all sockets
+        if cls.shared is None:
+            cls.shared = cls()
+        return cls.shared
+
+    def _buffer(self, shape: tuple, dtype) -> np.ndarray:
+        buffers = getattr(self.buffers, "pool", None)
+        if buffers is None:
+            buffers = self.buffers.pool = {}
+        key = (shape, np.dtype(dtype).str)
+        buffer = buffers.get(key)
+        if buffer is None:
+            buffer = buffers[key] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def scale(self, image: np.ndarray, maxWidth: int = 0) -> np.ndarray:
+        if not maxWidth or image.shape[1] <= maxWidth:
+            return image
+        rows = max(1, round(image.shape[0] * maxWidth / image.shape[1]))
+        target = self._buffer((rows, maxWidth) + image.shape[2:], image.dtype)
+        return cv2.resize(image, (maxWidth, rows), dst=target, interpolation=cv2.INTER_AREA)
+
+    def encodeSync(self, image: np.ndarray, quality: int = None, maxWidth: int = None,
+                   format: str = "jpg") -> tuple[bytes, tuple]:
+        # returns the encoded bytes and the (cols, rows, channels) castMessageEncoded expects
+        image = self.scale(image, self.maxWidth if maxWidth is None else maxWidth)
+        quality = self.quality if quality is None else quality
+        match format:
+            case "jpg":
+                params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+            case "webp":
+                params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+            case "png":
+                params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+            case _:
+                raise ValueError(f"unsupported format {format}")
+        ok, encoded = cv2.imencode("." + format, image, params)
+        if not ok:
+            raise ValueError(f"encoding {image.shape} as {format} failed")
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        return encoded.tobytes(), (image.shape[1], image.shape[0], channels)
+
+    def decodeSync(self, data, reduce: int = 1, grayscale: bool = False, out: np.ndarray = None) -> np.ndarray:
+        # reduce 2/4/8 lets libjpeg decode at a fraction of the resolution.
+        # out receives the decoded image, resized to its shape if needed
+        flags = (self.REDUCED_GRAYSCALE if grayscale else self.REDUCED_COLOR)[reduce]
+        if grayscale and reduce == 1:
+            flags = cv2.IMREAD_GRAYSCALE
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+        if img is None:
+            raise ValueError("could not decode image")
+        if out is None:
+            return img
+        if out.shape[:2] == img.shape[:2]:
+            np.copyto(out, img.reshape(out.shape))
+        else:
+            cv2.resize(img, (out.shape[1], out.shape[0]), dst=out, interpolation=cv2.INTER_AREA)
+        return out
+
+    async def encode(self, image: np.ndarray, quality: int = None, maxWidth: int = None,
+                     format: str = "jpg") -> tuple[bytes, tuple]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.encodeSync, image, quality, maxWidth, format)
+
+    async def decode(self, data, reduce: int = 1, grayscale: bool = False, out: np.ndarray = None) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.decodeSync, data, reduce, grayscale, out)
+
+
 class SocketInterface:
     cancelToken: bool = False
     event = asyncio.Event()
@@ -43,13 +1101,41 @@ class SocketInterface:
     lock = asyncio.Lock()
     id : int = -1
     helper = ImageHelper()
-    sendQueue: queue.PriorityQueue = None
+    sendQueue: SendScheduler = None
     
+    sharedContextInstance: zmq.asyncio.Context = None
+    sharedContextPid: int = None
+
+    @classmethod
+    def sharedContext(cls, ioThreads: int = None) -> zmq.asyncio.Context:
+        # one context per process, io threads from IPC_IO_THREADS for multi camera setups.
+        # a forked child must not use the context of its parent, it gets a new one
+        if (cls.sharedContextInstance is None or cls.sharedContextInstance.closed
+                or cls.sharedContextPid != os.getpid()):
+            if ioThreads is None:
+                ioThreads = int(os.environ.get("IPC_IO_THREADS", 1))
+            cls.sharedContextInstance = zmq.asyncio.Context(io_threads=ioThreads)
+            cls.sharedContextPid = os.getpid()
+        elif ioThreads is not None and cls.sharedContextInstance.get(zmq.IO_THREADS) != ioThreads:
+            logger.warning(f"Shared zmq context already runs {cls.sharedContextInstance.get(zmq.IO_THREADS)} io threads")
+        return cls.sharedContextInstance
+
     def connect(self, showInfo = True) -> None:
         global logger
+        if hasattr(self, "socket"):
+            self.metrics.reconnects += 1
+            # the old socket would otherwise stay open with its file descriptors until gc
+            if not self.socket.closed:
+                self.socket.close(linger=0)
         self.socket = self.context.socket(self.socket_type)
+        self.socket.setsockopt(zmq.LINGER, self.linger)
+        for topic in self.subscriptions:
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
         # self.cancelToken = False
         self.stop = False
+        if (self.conflate == "native"):
+            # has to be set before bind/connect, only valid for single part messages
+            self.socket.setsockopt(zmq.CONFLATE, 1)
 
         if (self.bind):
             if(showInfo): logger.info("Binding to " + self.IPCConnection_Control)
@@ -81,64 +1167,169 @@ class SocketInterface:
         if(self.socket_type == zmq.SocketType.REQ):
             self.socket.setsockopt(zmq.REQ_RELAXED, 1)
     
-    async def worker(self):
-        while (not self.cancelToken):
-            item = self.sendQueue.get()
-            try:
-                await self.socket.send(item[1])
-
-                if self.send_answer:
-                    # logger.info("Waiting for answer")
-                    reply = await self.socket.recv()
-
-                    # return reply
-            except asyncio.CancelledError:
-                # if (sent):
-                #     await self.socket.recv()
-                logger.error('Canceled sending')
-                self.sendQueue.task_done()
-
-                raise
-            except zmq.error.ZMQError as excp:
-                if(excp.errno != 11):
-                    logger.error(self.IPCConnection_Control)
-                    logger.error(excp.errno)
-                    logger.error(excp)
-                self.connect(False)
-
-            self.sendQueue.task_done()
-            if(len(item)==3 and item[2] is not None):
-                item[2].set()
+    def subscribe(self, topic: Union[bytes, str] = b"") -> None:
+        # use this instead of setsockopt(zmq.SUBSCRIBE), a reconnect creates a new socket
+        # that would otherwise receive nothing
+        topic = topic.encode() if isinstance(topic, str) else topic
+        if topic not in self.subscriptions:
+            self.subscriptions.append(topic)
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
 
+    def unsubscribe(self, topic: Union[bytes, str] = b"") -> None:
+        topic = topic.encode() if isinstance(topic, str) else topic
+        if topic in self.subscriptions:
+            self.subscriptions.remove(topic)
+            self.socket.setsockopt(zmq.UNSUBSCRIBE, topic)
 
+    async def _scheduledSend(self, message) -> Union[bytes, None]:
+        socket = self._schedulerSocket()
+        try:
+            started = time.perf_counter()
+            if isinstance(message, list):
+                await socket.send_multipart(message, copy=not self.zeroCopy)
+            else:
+                await socket.send(message)
+            self.metrics.observe("send", time.perf_counter() - started)
+            self.metrics.sent(messageSize(message))
+            if self.send_answer:
+                return await socket.recv()
+            return None
+        except zmq.error.ZMQError as excp:
+            if(excp.errno != 11):
+                logger.error(self.IPCConnection_Control)
+                logger.error(excp.errno)
+                logger.error(excp)
+            self.connect(False)
+            raise
 
+    def _schedulerSocket(self) -> zmq.asyncio.Socket:
+        # on its own I/O thread the scheduler uses a shadow of the socket bound to that loop,
+        # the socket must then only be used through the queue
+        if self.sendQueue.thread is None:
+            return self.socket
+        if self.ioSocket is None or self.ioSocket.underlying != self.socket.underlying:
+            self.ioSocket = zmq.asyncio.Socket.shadow(self.socket.underlying)
+        return self.ioSocket
 
     def __init__(self, IPCControl: str, bind: bool = False,
                  type: zmq.SocketType = zmq.SocketType.SUB,
-                 id: int = -1, queueSending: bool = False) -> None:
+                 id: int = -1, queueSending: bool = False,
+                 sharedMemory: bool = False, shmSlots: int = 4, shmPath: str = None,
+                 zeroCopy: bool = False, schedulerThread: bool = None,
+                 queueMaxDepth: int = 0, queueMaxBytes: int = 0,
+                 queuePolicy: SendPolicy = SendPolicy.BLOCK,
+                 queuePolicies: Dict[int, SendPolicy] = None,
+                 conflate: Union[bool, str] = False,
+                 headerFormat: str = None,
+                 context: zmq.asyncio.Context = None, linger: int = 1000) -> None:
         logger = logging.getLogger("Zeromq")
         logger.setLevel(logging.INFO)
         
-        self.context = zmq.asyncio.Context()
+        self.context = context if context is not None else SocketInterface.sharedContext()
+        self.linger = linger
+        # per socket, the class level lock would serialize every camera and app
+        self.lock = asyncio.Lock()
+        self.queueLock = asyncio.Lock()
+        self.failures = 0
+        self.dumps = DumpWriter.default()
+        # IPCRecorder tap, sees every message zmqloop receives
+        self.recorder = None
+        # DEALER for pipelined control commands, opened on first use
+        self.pipeline: zmq.asyncio.Socket = None
+        self.pipelineLock = asyncio.Lock()
         self.bind = bind
         self.IPCConnection_Control = IPCControl
         self.socket_type = type
         self.id = id
+        # SUB topics set through subscribe(), connect() applies them to every new socket
+        self.subscriptions: list = []
+
+        # conflate=True makes zmqloop skip to the newest queued message, "native" uses
+        # ZMQ_CONFLATE which drops multipart header+data messages and only fits shared memory frames
+        self.conflate = conflate
+        self.skippedFrames = 0
+        self.lastSkipped = 0
+
+        # "msgpack" (default) or "binary" FrameHeader for sent frames, receiving accepts both
+        self.headerFormat = headerFormat or os.environ.get("IPC_HEADER_FORMAT", "msgpack")
+        self.sequence = 0
+
+        # gauges only hold weak references, a cycle through the metrics would leave the
+        # socket to the garbage collector, which can finalize the context first and hang in term()
+        this = weakref.ref(self)
+        self.metrics = IPCMetrics(IPCControl, id)
+        self.metrics.gauges["skipped_frames"] = lambda: getattr(this(), "skippedFrames", 0)
+
+        # sending side: frames are copied into a ring and only referenced in the message
+        self.sharedMemory = sharedMemory
+        self.shmSlots = shmSlots
+        self.shmPath = shmPath if shmPath is not None else SharedFrameRing.pathForEndpoint(IPCControl)
+        self.shmRing: SharedFrameRing = None
+        # receiving side: rings opened on demand, keyed by path. Paths that failed to open
+        # are warned about once
+        self.shmRings: Dict[str, SharedFrameRing] = {}
+        self.shmUnavailable: set = set()
+
+        # send numpy buffers without tobytes() and receive zmq.Frame buffers instead of bytes
+        self.zeroCopy = zeroCopy
+        self.lastTracker: zmq.MessageTracker = None
         
+        # queued sending is started with the first message, on the caller loop
+        # or, if schedulerThread is set or there is no running loop, on an I/O thread
+        self.schedulerThread = schedulerThread
+        self.ioSocket: zmq.asyncio.Socket = None
         if queueSending:
-            self.sendQueue = queue.PriorityQueue()
-            self.workerThread = threading.Thread(target=asyncio.run, args=(self.worker(),))
-            self.workerThread.start()
+            # by default only the newest liveview frame (prio 0) is kept, everything else waits for room
+            if queuePolicies is None:
+                queuePolicies = {0: SendPolicy.LATEST}
+            self.sendQueue = SendScheduler(weakref.WeakMethod(self._scheduledSend), IPCControl,
+                                           queueMaxDepth, queueMaxBytes, queuePolicy, queuePolicies)
+            self.sendQueue.metrics = self.metrics
+            sendQueue = weakref.ref(self.sendQueue)
+            self.metrics.gauges["queue_depth"] = lambda: sendQueue().qsize() if sendQueue() else 0
+            self.metrics.gauges["queue_bytes"] = lambda: sendQueue().queuedBytes if sendQueue() else 0
+            self.metrics.gauges["queue_dropped"] = lambda: sum(sendQueue().dropped.values()) if sendQueue() else 0
 
 
 
         self.connect()
 
 
-    def enqueue_message(self, message: bytes, prio: int = 1, event: asyncio.Event = None):
-        self.sendQueue.put((prio, message, event))
-        
-           
+    def enqueue_message(self, message: Union[bytes, list], prio: int = 1, event: asyncio.Event = None,
+                        policy: SendPolicy = None) -> concurrent.futures.Future:
+        self.sendQueue.start(self.schedulerThread)
+        return self.sendQueue.submit(message, prio, event, policy)
+
+    async def enqueue_message_wait(self, message: Union[bytes, list], prio: int = 1, event: asyncio.Event = None,
+                                   policy: SendPolicy = None) -> concurrent.futures.Future:
+        self.sendQueue.start(self.schedulerThread)
+        return await self.sendQueue.submitWait(message, prio, event, policy)
+
+    @property
+    def droppedFrames(self) -> Dict[int, int]:
+        if self.sendQueue is None:
+            return {}
+        return self.sendQueue.stats()["dropped"]
+
+    def close(self, linger: int = 0) -> None:
+        if self.sendQueue is not None:
+            self.sendQueue.stop()
+        if self.pipeline is not None:
+            self.pipeline.close(linger=0)
+        self.socket.close(linger=linger)
+        if self.shmRing is not None:
+            self.shmRing.close()
+            self.shmRing = None
+            try:
+                os.remove(self.shmPath)
+            except OSError:
+                pass
+        for ring in self.shmRings.values():
+            ring.close()
+        self.shmRings.clear()
+
+    def isHealthy(self, maxFailures: int = 3) -> bool:
+        return not self.socket.closed and self.failures < maxFailures
 
     def __del__(self) -> None:
         pass
@@ -166,12 +1357,10 @@ class SocketInterface:
         #         return False
 
     async def sendV4Command(self, command_name: str, meta: dict = None, retry: bool = True, msgPack: bool = True) -> bool | dict:
-        logger.info("COMMAND")
-
         command = {"command": command_name, "type": int(ParameterType.COMMAND)}
         if meta is not None:
             command.update(meta)
-        logger.info(command)
+        IPCLogging.event(self.IPCConnection_Control, "Command %s", command)
 
         sent = False
         MAX_RETRIES = 5
@@ -181,42 +1370,117 @@ class SocketInterface:
         else:
             msgCommand = json.dumps(command)
 
-        # async with self.lock:
-        while (not sent and retry < MAX_RETRIES):
-            retry += 1            
-            try:
-                if(msgPack):                    
-                    await self.socket.send(msgCommand)
-                else:
-                    await self.socket.send(b'', flags=zmq.SNDMORE)
-                    await self.socket.send_string(msgCommand)
-                if self.send_answer:
-                    # logger.info("Waiting for answer")
-                    if(msgPack): 
-                        answer = await self.socket.recv()
+        # requests on a pooled REQ socket have to be strictly alternating
+        async with self.lock:
+            while (not sent and retry < MAX_RETRIES):
+                retry += 1            
+                try:
+                    if(msgPack):                    
+                        await self.socket.send(msgCommand)
                     else:
-                        answer = await self.socket.recv()
+                        await self.socket.send(b'', flags=zmq.SNDMORE)
+                        await self.socket.send_string(msgCommand)
+                    if self.send_answer:
+                        # logger.info("Waiting for answer")
+                        if(msgPack): 
+                            answer = await self.socket.recv()
+                        else:
+                            answer = await self.socket.recv()
 
-                        # answer = await self.socket.recv_multipart()
-                        # print(answer)
-                        # answer = json.loads(answer[1])
-                    logger.info(f"Answer: {answer}")
-                    return msgpack.unpackb(answer, raw=False)
+                            # answer = await self.socket.recv_multipart()
+                            # print(answer)
+                            # answer = json.loads(answer[1])
+                        IPCLogging.event(self.IPCConnection_Control, "Answer: %s", answer)
+                        self.failures = 0
+                        return msgpack.unpackb(answer, raw=False)
                     
-                sent = True
-            except zmq.error.ZMQError as excp:
-                if(excp.errno != 11):
-                    logger.error(self.IPCConnection_Control)
-                    logger.error(excp)
-                    logger.error(excp.errno)
-                    if(not self.bind):
-                        self.connect(True)
-                    if(retry == 1):
-                        continue
+                    sent = True
+                except zmq.error.ZMQError as excp:
+                    self.failures += 1
+                    if(excp.errno != 11):
+                        logger.error(self.IPCConnection_Control)
+                        logger.error(excp)
+                        logger.error(excp.errno)
+                        if(not self.bind):
+                            self.connect(True)
+                        if(retry == 1):
+                            continue
            
-            if (not retry):
-                break
-        return sent
+                if (not retry):
+                    break
+            return sent
+
+    def _pipelineSocket(self) -> zmq.asyncio.Socket:
+        # a DEALER next to the REQ socket can have many requests in flight. The REP peer
+        # answers strictly in order, so replies are matched by position
+        if self.pipeline is None or self.pipeline.closed:
+            self.pipeline = self.context.socket(zmq.DEALER)
+            self.pipeline.setsockopt(zmq.LINGER, 0)
+            self.pipeline.connect(self.IPCConnection_Control)
+        return self.pipeline
+
+    async def sendV4Commands(self, commands: list, timeout: float = 5.0, window: int = 32,
+                             msgPack: bool = True) -> list:
+        # commands are (command_name, meta) tuples or complete command dicts as stored in
+        # cameraSettings.json. Returns one entry per command: the unpacked answer, a
+        # ValueError for an answer that does not decode (the REP side replies a plain
+        # error string when a handler fails), or the exception (TimeoutError, ZMQError)
+        # for commands without answer within timeout
+        if self.bind or self.socket_type != zmq.SocketType.REQ:
+            raise ValueError("pipelined commands need a connecting REQ control socket")
+        payloads = []
+        for entry in commands:
+            if isinstance(entry, dict):
+                command = {"type": int(ParameterType.COMMAND)}
+                command.update(entry)
+            else:
+                name, meta = entry if isinstance(entry, (tuple, list)) else (entry, None)
+                command = {"command": name, "type": int(ParameterType.COMMAND)}
+                if meta is not None:
+                    command.update(meta)
+            payloads.append(msgpack.dumps(command) if msgPack else json.dumps(command).encode())
+
+        results: list = [None] * len(payloads)
+        async with self.pipelineLock:
+            socket = self._pipelineSocket()
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            sent = 0
+            received = 0
+            try:
+                while received < len(payloads):
+                    while sent < len(payloads) and sent - received < window:
+                        await socket.send_multipart([b"", payloads[sent]])
+                        sent += 1
+                    reply = await asyncio.wait_for(socket.recv_multipart(), max(deadline - loop.time(), 0))
+                    answer = reply[-1]
+                    try:
+                        results[received] = msgpack.unpackb(answer, raw=False) if msgPack else answer.decode()
+                    except Exception as excp:
+                        logger.error(f"{self.IPCConnection_Control}: command {received} answered {answer[:200]!r}")
+                        results[received] = ValueError(f"undecodable answer {answer[:200]!r}: {excp}")
+                    received += 1
+            except BaseException as excp:
+                logger.error(f"{self.IPCConnection_Control}: {len(payloads) - received} commands unanswered: {excp!r}")
+                # late answers would be matched to the wrong request, start over with a new socket
+                self.pipeline.close(linger=0)
+                self.pipeline = None
+                self.failures += 1
+                if not isinstance(excp, Exception):
+                    raise
+                for index in range(received, len(payloads)):
+                    results[index] = TimeoutError(f"no answer within {timeout} s") if isinstance(
+                        excp, asyncio.TimeoutError) else excp
+            else:
+                self.failures = 0
+        return results
+
+    async def applyV4Settings(self, settings: Union[str, list], timeout: float = 5.0) -> list:
+        # replays a cameraSettings.json (path or loaded list) in one pipelined batch
+        if isinstance(settings, str):
+            with open(settings) as f:
+                settings = json.load(f)
+        return await self.sendV4Commands(settings, timeout)
 
     async def sendCommand(self, command: CommandType, name: str = ""):
         jCommand = {"type": 5, "command": int(command), "name": name}
@@ -227,10 +1491,11 @@ class SocketInterface:
             try:
 
                 await self.socket.send(message)
-                logger.info("Sent message")
+                self.metrics.sent(len(message))
+                IPCLogging.event(self.IPCConnection_Control, "Sent message")
                 if self.send_answer:
                     reply  = await self.socket.recv()
-                    logger.info("Received message")
+                    IPCLogging.event(self.IPCConnection_Control, "Received message")
 
                     return reply
                 return None
@@ -240,17 +1505,46 @@ class SocketInterface:
                 return None
                 
                 
+    def attachRecorder(self, recorder) -> None:
+        # recorder.record(parts) is called for every received message, None detaches
+        self.recorder = recorder
+
+    async def sendMultipart(self, parts: list, prio: int = 1, policy: SendPolicy = None) -> Union[list,None]:
+        # sends already encoded message parts, e.g. replayed recordings
+        if self.sendQueue is not None:
+            return await self.enqueue_message_wait(parts, prio, None, policy)
+        async with self.lock:
+            try:
+                started = time.perf_counter()
+                await self.socket.send_multipart(parts, copy=False)
+                self.metrics.observe("send", time.perf_counter() - started)
+                self.metrics.sent(messageSize(parts))
+                if self.send_answer:
+                    return await self.socket.recv_multipart()
+                return None
+            except zmq.error.ZMQError as excp:
+                if(excp.errno != 11):
+                    logger.error(self.IPCConnection_Control)
+                    logger.error(excp)
+                self.connect(False)
+                return None
+
     async def sendString(self, message: str):
         await self.send(message.encode())
         
         
     
     def castMessage(self,image: cv2.Mat, meta: dict = None, ismsgPack= True) -> bytes:
+        if(ismsgPack and self.headerFormat == "binary"):
+            return self.castHeaderBinary(image, "raw", meta)
         msg = {"dataformat": {"type": "raw",
                                 "rows": image.shape[0], 
                               "cols": image.shape[1],
                               "channels": 1 if len(
             image.shape) == 2 else image.shape[2]}}
+        if(image.dtype != np.uint8):
+            # older receivers assume uint8, the key is only sent when it matters
+            msg["dataformat"]["dtype"] = image.dtype.name
         if(meta is not None):
             msg.update({"meta":meta})
         if(ismsgPack):
@@ -259,51 +1553,177 @@ class SocketInterface:
         else:
             return json.dumps(msg)
     
+    def castHeaderBinary(self, image: np.ndarray, format: str = "raw", meta: dict = None,
+                         shm: dict = None, shape: tuple = None) -> bytes:
+        self.sequence += 1
+        frameId = meta.get("frameId", self.sequence) if isinstance(meta, dict) else self.sequence
+        if shape is None:
+            shape = image.shape
+        # the data frame is sent contiguous, strides describe that layout
+        return FrameHeader.pack(format, shape, image.dtype if image is not None else np.uint8,
+                                timestamp=int(time.time() * 1000), frameId=frameId,
+                                sequence=self.sequence, meta=meta, shm=shm)
+
     def castMessageEncoded(self,image: bytes, shape: list= (1,1,1), type: str = "jpg", meta:dict = None):
         msg = {"dataformat": {"type": type, "cols": shape[0], "rows": shape[1], "channels": shape[2]}, "data": image}
         if(meta is not None):
             msg.update({"meta":meta})
         return msgpack.dumps(msg)
 
-    async def sendImage(self, image: cv2.Mat, meta: dict = None, event: asyncio.Event = None, msgpack= True) -> Union[bytes,None]:       
-        
-        async with self.lock:
+    def castMessageShared(self, image: cv2.Mat, meta: dict = None) -> bytes:
+        if self.shmRing is None:
+            self.shmRing = SharedFrameRing(self.shmPath, self.shmSlots, image.nbytes, create=True)
+        slot, generation = self.shmRing.write(image)
+        shm = {"path": self.shmRing.path, "ring": self.shmRing.ringId, "slot": slot, "generation": generation}
+        if(self.headerFormat == "binary"):
+            return self.castHeaderBinary(image, "raw", meta, shm)
+        msg = {"dataformat": {"type": "raw",
+                              "rows": image.shape[0],
+                              "cols": image.shape[1],
+                              "channels": 1 if len(image.shape) == 2 else image.shape[2]},
+               "shm": shm}
+        if(image.dtype != np.uint8):
+            msg["dataformat"]["dtype"] = image.dtype.name
+        if(meta is not None):
+            msg.update({"meta":meta})
+        return msgpack.dumps(msg)
 
-            sent: bool = False           
-            
-            msg = self.castMessage(image, meta, msgpack)
+    def resolveShared(self, message: dict) -> np.ndarray:
+        # returns a read only view onto the slot, valid until the producer wraps around
+        ref = message["shm"]
+        ring = self.shmRings.get(ref["path"])
+        if ring is None or ring.ringId != ref["ring"]:
+            if ring is not None:
+                ring.close()
+                del self.shmRings[ref["path"]]
+            try:
+                ring = SharedFrameRing(ref["path"])
+            except (OSError, ValueError) as e:
+                if ref["path"] not in self.shmUnavailable:
+                    self.shmUnavailable.add(ref["path"])
+                    logger.warning(f"Skipping shared memory frames of {ref['path']}, is IPC_SHM_DIR shared "
+                                   f"with the sender? {e}")
+                raise SharedRingUnavailable(f"cannot open {ref['path']}: {e}") from e
+            self.shmUnavailable.discard(ref["path"])
+            self.shmRings[ref["path"]] = ring
+        rows, cols, channels = itemgetter('rows', 'cols', 'channels')(message["dataformat"])
+        return ring.view(ref["slot"], ref["generation"], (rows, cols, channels),
+                         np.dtype(message["dataformat"].get("dtype", "uint8")))
 
-            if(self.sendQueue is not None):            
-                self.enqueue_message(msg)
-            else:
-                try:
-                    if(msgpack):
-                        await self.socket.send(image.tobytes(), flags=zmq.SNDMORE)
-                        await self.socket.send(msg, flags=zmq.NOBLOCK)
-                    else:
-                        await self.socket.send(image.tobytes(), flags=zmq.SNDMORE)
-                        await self.socket.send_string(msg, flags=zmq.NOBLOCK)
-                    if self.send_answer:
-                        # logger.info("Waiting for answer")
-                        reply = await self.socket.recv_multipart()
-                        if (len(reply) == 1):
-                            reply = reply[0]
-                        return reply
-                except zmq.error.ZMQError as excp:
-                    if(excp.errno != 11):
-                        logger.error(self.IPCConnection_Control)
-                        logger.error(excp.errno)
-                        logger.error(excp)
-                    self.connect(False)
+    async def waitSent(self, timeout: float = None) -> bool:
+        # zeromq reads the numpy buffer asynchronously when sending without copy,
+        # a producer reusing its frame buffer has to wait for the tracker first
+        tracker = self.lastTracker
+        if tracker is None or tracker.done:
+            return True
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, tracker.wait, -1 if timeout is None else timeout)
+        except zmq.NotDone:
+            return False
+        return True
+
+    def castForSend(self, image: cv2.Mat, meta: dict, msgpack: bool) -> tuple:
+        # returns the header and whether the frame went to the shared ring, called with self.lock held
+        shared = self.sharedMemory and msgpack
+        if(shared):
+            try:
+                return self.castMessageShared(image, meta), True
+            except SharedMemoryFull as e:
+                # the frame and everything after it go out as normal multipart messages
+                logger.warning(f"Shared memory disabled for {self.IPCConnection_Control}: {e}")
+                self.sharedMemory = False
+                self.shmRing = None
+        return self.castMessage(image, meta, msgpack), False
+
+    async def sendImage(self, image: cv2.Mat, meta: dict = None, event: asyncio.Event = None, msgpack= True,
+                        prio: int = 1, policy: SendPolicy = None) -> Union[bytes,None]:       
+
+        if(self.sendQueue is not None):
+            # waiting for queue room must not hold self.lock, sendImageEncoded would wait
+            # behind it. queueLock keeps the frames of concurrent callers in order
+            async with self.queueLock:
+                async with self.lock:
+                    msg, shared = self.castForSend(image, meta, msgpack)
+                    if(not shared):
+                        if(not msgpack):
+                            msg = msg.encode()
+                        # queued frames outlive this call and the producer may reuse its buffer,
+                        # so they are snapshotted. with zero copy the snapshot is sent without another copy
+                        data = np.array(image, order="C") if self.zeroCopy else image.tobytes()
+                        msg = [msg, data]
+                await self.enqueue_message_wait(msg, prio, event, policy)
+            return
+
+        async with self.lock:
+
+            msg, shared = self.castForSend(image, meta, msgpack)
+            try:
+                started = time.perf_counter()
+                # header first, zmqloop unpacks messages[0] and takes messages[1] as data
+                if(shared):
+                    await self.socket.send(msg, flags=zmq.NOBLOCK)
+                elif(self.zeroCopy):
+                    if(not msgpack):
+                        msg = msg.encode()
+                    frame = np.ascontiguousarray(image)
+                    self.lastTracker = await self.socket.send_multipart(
+                        [msg, memoryview(frame).cast("B")], flags=zmq.NOBLOCK, copy=False, track=True)
+                elif(msgpack):
+                    await self.socket.send(msg, flags=zmq.SNDMORE)
+                    await self.socket.send(image.tobytes(), flags=zmq.NOBLOCK)
+                else:
+                    await self.socket.send_string(msg, flags=zmq.SNDMORE)
+                    await self.socket.send(image.tobytes(), flags=zmq.NOBLOCK)
+                self.metrics.observe("send", time.perf_counter() - started)
+                self.metrics.sent(len(msg) + (0 if shared else image.nbytes))
+                if self.send_answer:
+                    # logger.info("Waiting for answer")
+                    reply = await self.socket.recv_multipart()
+                    if (len(reply) == 1):
+                        reply = reply[0]
+                    return reply
+            except zmq.error.ZMQError as excp:
+                if(excp.errno != 11):
+                    logger.error(self.IPCConnection_Control)
+                    logger.error(excp.errno)
+                    logger.error(excp)
+                self.connect(False)
 
         
-    async def sendImageEncoded(self, image: bytes,shape: list= (1,1,1), meta: dict = None):       
+    async def sendImageJpeg(self, image: cv2.Mat, meta: dict = None, quality: int = None, maxWidth: int = None,
+                            format: str = "jpg"):
+        # encodes on the shared codec pool, maxWidth defaults to CAMERA_MAX_WIDTH_JPG (1000), 0 keeps the size
+        encoded, shape = await FrameCodec.default().encode(image, quality, maxWidth, format)
+        return await self.sendImageEncoded(encoded, shape, meta, format)
+
+    async def sendImageEncoded(self, image: bytes,shape: list= (1,1,1), meta: dict = None, format: str = "jpg"):
+        # returns the send future when queued
+
+        if(self.headerFormat == "binary"):
+            # header and encoded bytes travel as two frames like raw images
+            msg = [self.castHeaderBinary(None, format, meta, shape=(shape[1], shape[0], shape[2])), image]
+        else:
+            msg = self.castMessageEncoded(image,shape,format,  meta)           
+
+        if(self.sendQueue is not None):
+            # liveview goes ahead of queued raw frames and does not wait for self.lock,
+            # held by sendImage only while it casts a frame
+            return self.enqueue_message(msg,0)
 
         async with self.lock:         
-            
-            msg = self.castMessageEncoded(image,shape,"jpg",  meta)           
-            
-            self.enqueue_message(msg,0)
+            try:
+                if isinstance(msg, list):
+                    await self.socket.send_multipart(msg, flags=zmq.NOBLOCK)
+                else:
+                    await self.socket.send(msg, flags=zmq.NOBLOCK)
+                if self.send_answer:
+                    await self.socket.recv()
+            except zmq.error.ZMQError as excp:
+                if(excp.errno != 11):
+                    logger.error(self.IPCConnection_Control)
+                    logger.error(excp)
+                self.connect(False)
      
 
      
@@ -312,189 +1732,700 @@ class SocketInterface:
     def dispatchImage(self, image):
         self.q.put(image)
 
-    def castImage(self, message: dict) -> cv2.Mat:
+    def castImage(self, message: dict, reduce: int = 1, grayscale: bool = False) -> cv2.Mat:
+        # encoded images keep their colour unless grayscale is asked for, the channels of
+        # the header are not reliable since castMessageEncoded defaults to (1,1,1)
+        if "data" not in message and "shm" in message:
+            return self.resolveShared(message)
         data = message['data']
         match message['dataformat']['type']:
-            case 'jpg':
-                input = np.frombuffer(bytes(data), np.uint8)                           
-
-                img = cv2.imdecode(input,cv2.IMREAD_ANYCOLOR)
-                print(img.shape)
+            case 'jpg' | 'webp' | 'png':
+                img = FrameCodec.default().decodeSync(data, reduce, grayscale)
             case 'raw':
-                rows, cols, channels = itemgetter('rows', 'cols', 'channels')(message["dataformat"])
-
-                img = np.frombuffer(data, dtype=np.uint8)
-                img = np.reshape(img, (rows, cols, channels))
+                img = frameArray(data, message["dataformat"])
             case 'both':
-                rows, cols, channels = itemgetter('rows', 'cols', 'channels')(message["dataformat"])
-
-                img = np.frombuffer(data, dtype=np.uint8)
-                img = np.reshape(img, (rows, cols, channels))
+                img = frameArray(data, message["dataformat"])
             case _:
-                print("no")
+                logger.warning("Unknown image type %s", message['dataformat']['type'])
         return img
-    def castImageMultiMessage(self, message: tuple[dict,np.ndarray]) -> cv2.Mat:
+    def castImageMultiMessage(self, message: tuple[dict,np.ndarray], reduce: int = 1, grayscale: bool = False) -> cv2.Mat:
         data = message[1]
         message = message[0]
+        if data is None and "shm" in message:
+            return self.resolveShared(message)
         match message['dataformat']['type']:
-            case 'jpg':
-                input = np.frombuffer(bytes(data), np.uint8)                           
-
-                img = cv2.imdecode(input,cv2.IMREAD_ANYCOLOR)
-                print(img.shape)
+            case 'jpg' | 'webp' | 'png':
+                img = FrameCodec.default().decodeSync(data, reduce, grayscale)
             case 'raw':
-                rows, cols, channels = itemgetter('rows', 'cols', 'channels')(message["dataformat"])
-
-                img = np.frombuffer(data, dtype=np.uint8)
-                img = np.reshape(img, (rows, cols, channels))
+                img = frameArray(data, message["dataformat"])
             case 'both':
-                rows, cols, channels = itemgetter('rows', 'cols', 'channels')(message["dataformat"])
-
-                img = np.frombuffer(data, dtype=np.uint8)
-                img = np.reshape(img, (rows, cols, channels))
+                img = frameArray(data, message["dataformat"])
             case _:
-                print("no")
+                logger.warning("Unknown image type %s", message['dataformat']['type'])
         return img
 
-    async def zmqloop(self, callbacks: Dict[str,SocketCallback] = {}, isMsgpack: bool = True):
-        global logger
-        logger.info("Starting loop for " + self.IPCConnection_Control)
-
-        while not self.cancelToken:
-            await asyncio.sleep(0.001)
-            # logger.info(f"Next round {self.IPCConnection_Control}")
+    def castImageView(self, message: Union[dict, tuple], view: FrameView) -> np.ndarray:
+        # like castImage / castImageMultiMessage, but only builds what view asks for
+        if isinstance(message, tuple):
+            message = {**message[0], "data": message[1]}
+        if message.get("data") is None and "shm" in message:
+            return view.applyArray(self.resolveShared(message))
+        return view.apply(message["data"], message["dataformat"])
 
-            try:
-                messages = await self.socket.recv_multipart()  # will wait for the next message
+    async def castImageAsync(self, message: dict, reduce: int = 1, grayscale: bool = False) -> cv2.Mat:
+        # like castImage, but JPEG decoding runs on the codec pool instead of the event loop
+        if message.get('dataformat', {}).get('type') in FrameCodec.ENCODED and 'data' in message:
+            return await FrameCodec.default().decode(message['data'], reduce, grayscale)
+        return self.castImage(message, reduce, grayscale)
 
-                logger.debug("Received message")
+    def unpackMessage(self, messages: list, isMsgpack: bool = True) -> Union[dict, None]:
+        # turns a received multipart message into the dict handed to callbacks,
+        # None if the message has to be skipped
+        if isMsgpack:
+            if isinstance(messages, list) and len(messages) > 0:
+                IPCLogging.event(self.IPCConnection_Control, "Received message as multipart")
 
                 try:
-                    startLoad = time.time()
-                    if(isMsgpack):                      
-                        if isinstance(messages, list) and len(messages) > 0:
-                            logger.info("Received message as multipart")
-                            
-                            try:
-                                image_pack = msgpack.unpackb(
-                                    messages[0], 
-                                    strict_map_key=False,
-                                    raw=False,
-                                    use_list=True
-                                )
-                            except TypeError as te:
-                                # If we get unhashable type error, the message has malformed data
-                                # (dict used as a key). This is a sender issue, skip this message.
-                                if "unhashable type" in str(te):
-                                    logger.warning(f"Skipping message with malformed msgpack data (unhashable key): {te}")
-                                    logger.warning(f"Message size: {len(messages[0])} bytes")
-                                    # Write the binary data to a log file for analysis
-                                    with open("unhashable_msgpack.bin", "wb") as f:
-                                        f.write(messages[0])
-                                    logger.warning("Binary data written to unhashable_msgpack.bin for analysis")
-                                    continue
-
-                            except (ValueError, msgpack.exceptions.OutOfData) as e:
-                                logger.error(f"Msgpack unpacking error: {e}")
-                                logger.error(f"Message type: {type(messages[0])}")
-                                logger.error(f"Messages list length: {len(messages)}")
-                                # Write message raw to file for analysis
-                                try:
-                                    if isinstance(messages[0], (bytes, bytearray)):
-                                        logger.error(f"Message length: {len(messages[0])} bytes")
-                                        with open("msgpack_error_raw.bin", "wb") as f:
-                                            f.write(messages[0])
-                                        logger.error("Raw message written to msgpack_error_raw.bin for analysis")
-                                        # For incomplete input, just skip this message
-                                        if isinstance(e, msgpack.exceptions.OutOfData):
-                                            logger.warning("Incomplete msgpack message received, skipping")
-                                            continue
-                                    else:
-                                        logger.error("Message content: " + str(messages[0]))
-                                except Exception as file_exc:
-                                    logger.error(f"Failed to write raw message to file: {file_exc}")
-                                    continue
-                                # raise
-                        else:
-                            logger.error(f"Unexpected message type: {type(messages)}")
-                            # raise ValueError(f"Unexpected message type: {type(messages)}")
-                            
-                        if isinstance(messages, list) and len(messages) > 1:
-                            image_pack["data"] = messages[1]
-                        if isinstance(messages, list) and len(messages) > 2:                        
-                            image_pack["base64"] = messages[2].decode()
-                        
-                    else:
-                        image_pack = json.loads(messages[0])
-                        if isinstance(messages, list) and len(messages) > 1:
-                            image_pack["data"] = messages[1]
-                        if isinstance(messages, list) and len(messages) > 2:                        
-                            image_pack["base64"] = messages[2].decode()
-                    # if (not "data" in image_pack):             
-                    #     logger.info(f"Found key {image_pack}")
-
-                    keyFound = False
-                    detectedKey = ""
-                    result = None
-
-                    for key, fn in callbacks.items():
-                        if (key in image_pack):
-                            logger.debug(f"Found key {key}")
-                            if (inspect.iscoroutinefunction(fn)):
-                                if(self.id >= 0):
-                                    result = await fn(image_pack, self.id)
-                                else:
-                                    result = await fn(image_pack)
-                            else:
-                                if(self.id >= 0):
-                                    result = fn(image_pack, self.id)
-                                else:
-                                    result = fn(image_pack)
-                            keyFound = True
-                            detectedKey = key
-
-                    if (not keyFound):
-                        logger.info(image_pack.keys())
-                    elif ("data" not in image_pack):
-                        logger.debug(f"FOUND: {json.dumps(image_pack, indent=4)}")
+                    if FrameHeader.isBinary(messages[0]):
+                        image_pack = FrameHeader.unpack(messages[0])
                     else:
-                        logger.debug(f"Found key {detectedKey}")
-                    del image_pack
-                    if (self.send_answer):
-                        if(result is not None):
-                            await self.socket.send(result)
+                        image_pack = msgpack.unpackb(
+                            messages[0], 
+                            strict_map_key=False,
+                            raw=False,
+                            use_list=True
+                        )
+                except TypeError as te:
+                    # If we get unhashable type error, the message has malformed data
+                    # (dict used as a key). This is a sender issue, skip this message.
+                    if "unhashable type" in str(te):
+                        logger.warning(f"Skipping message with malformed msgpack data (unhashable key): {te}")
+                        logger.warning(f"Message size: {len(messages[0])} bytes")
+                        # Keep the binary data for analysis
+                        if self.dumps.record("unhashable_msgpack", messages[:1], te, self.IPCConnection_Control):
+                            logger.warning(f"Binary data queued for {self.dumps.directory} for analysis")
+                        return None
+                    raise
+
+                except (ValueError, msgpack.exceptions.OutOfData) as e:
+                    logger.error(f"Msgpack unpacking error: {e}")
+                    logger.error(f"Message type: {type(messages[0])}")
+                    logger.error(f"Messages list length: {len(messages)}")
+                    # Write message raw to file for analysis
+                    try:
+                        if isinstance(messages[0], (bytes, bytearray)):
+                            logger.error(f"Message length: {len(messages[0])} bytes")
+                            if self.dumps.record("msgpack_error_raw", messages[:1], e, self.IPCConnection_Control):
+                                logger.error(f"Raw message queued for {self.dumps.directory} for analysis")
+                            # For incomplete input, just skip this message
+                            if isinstance(e, msgpack.exceptions.OutOfData):
+                                logger.warning("Incomplete msgpack message received, skipping")
+                                return None
                         else:
-                            await self.socket.send(msgpack.dumps("OK"))
-                        # logger.info("Sent answer")
+                            logger.error("Message content: " + str(messages[0]))
+                    except Exception as file_exc:
+                        logger.error(f"Failed to record raw message: {file_exc}")
+                        return None
+                    raise
+            else:
+                logger.error(f"Unexpected message type: {type(messages)}")
+                return None
+
+            if isinstance(messages, list) and len(messages) > 1:
+                image_pack["data"] = messages[1]
+            elif "shm" in image_pack:
+                try:
+                    image_pack["data"] = self.resolveShared(image_pack)
+                except SharedRingUnavailable:
+                    return None
+                except StaleFrameError as e:
+                    logger.warning(f"Skipping shared memory frame: {e}")
+                    return None
+            if isinstance(messages, list) and len(messages) > 2:                        
+                image_pack["base64"] = bytes(messages[2]).decode()
+
+        else:
+            image_pack = json.loads(messages[0])
+            if isinstance(messages, list) and len(messages) > 1:
+                image_pack["data"] = messages[1]
+            if isinstance(messages, list) and len(messages) > 2:                        
+                image_pack["base64"] = bytes(messages[2]).decode()
+        return image_pack
+
+    async def receiveBatch(self, maxBatch: int = 1) -> list:
+        # waits for one message, then drains whatever else is already queued on the socket.
+        # returns (time read, message parts) pairs
+        while True:
+            socket = self.socket
+            try:
+                messages = await socket.recv_multipart(copy=not self.zeroCopy)  # will wait for the next message
+                break
+            except (asyncio.CancelledError, zmq.error.ZMQError):
+                # connect() closing the socket cancels a waiting recv, go on with the new socket.
+                # a cancelled task (cancelling() from 3.11 on) still stops
+                task = asyncio.current_task()
+                cancelling = getattr(task, "cancelling", None)
+                if self.socket is socket or (cancelling is not None and cancelling()):
+                    raise
+                logger.warning("Socket of %s was replaced while receiving", self.IPCConnection_Control)
+        batch = [(time.perf_counter(), messages)]
+        while len(batch) < maxBatch and socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            try:
+                messages = await socket.recv_multipart(flags=zmq.NOBLOCK, copy=not self.zeroCopy)
+            except zmq.error.Again:
+                break
+            batch.append((time.perf_counter(), messages))
+        if self.zeroCopy:
+            # header is small and gets unpacked anyway, payload frames stay in zmq owned memory.
+            # the memoryview keeps its frame alive as long as an array built on it exists
+            batch = [(receivedAt, [messages[0].bytes] + [frame.buffer for frame in messages[1:]])
+                     for receivedAt, messages in batch]
+        for _, messages in batch:
+            self.metrics.received(messageSize(messages))
+        return batch
+
+    async def zmqloop(self, callbacks: Dict[str,SocketCallback] = {}, isMsgpack: bool = True,
+                      concurrentCallbacks: bool = False, orderedKeys: list = None,
+                      executor: Union[concurrent.futures.Executor, int] = None,
+                      maxInFlight: int = 16, maxBatch: int = 64):
+        # concurrentCallbacks runs the callbacks of consecutive messages as tasks, callbacks
+        # of a key in orderedKeys still run one after another in message order.
+        # executor (or a thread count) takes the synchronous callbacks off the event loop.
+        # sockets that answer (REP, REQ, PAIR) handle one message at a time
+        global logger
+        logger.info("Starting loop for " + self.IPCConnection_Control)
+        dispatcher = CallbackDispatcher(callbacks, self.id, executor, orderedKeys, maxInFlight, self.metrics,
+                                        self.resolveShared)
+        if self.send_answer:
+            concurrentCallbacks = False
+            maxBatch = 1
+        conflate = self.conflate is True and not self.send_answer
+        if conflate:
+            maxBatch = sys.maxsize
+
+        try:
+            while not self.cancelToken:
+                messages = []
+                try:
+                    batch = await self.receiveBatch(maxBatch)
+                    if self.recorder is not None:
+                        for receivedAt, messages in batch:
+                            self.recorder.record(messages)
+
+                    logger.debug("Received message")
+
+                    if conflate:
+                        # only the newest complete message of the backlog is processed
+                        self.lastSkipped = len(batch) - 1
+                        self.skippedFrames += self.lastSkipped
+                        if self.lastSkipped:
+                            logger.debug("Skipped %d stale messages", self.lastSkipped)
+                        batch = batch[-1:]
+
+                    for receivedAt, messages in batch:
+                        if self.cancelToken:
+                            break
+                        await self.handleMessage(messages, dispatcher, isMsgpack, concurrentCallbacks, receivedAt)
+
+                except zmq.error.Again as excp:
+                    #pass
+                    if(excp.errno != 11):
+                        logger.error(self.IPCConnection_Control)
+                        logger.error(excp.errno)
+                        logger.error(excp)
+                        self.connect(False)
+                 
+
                 except Exception as e:
-                    # logger.error(messages)
-                    logger.error(e)
-                    logger.error("Failed to process message")
-                    # Write the binary data to a log file for analysis
-                    try:
-                        if isinstance(messages, list) and len(messages) > 0 and isinstance(messages[0], (bytes, bytearray)):
-                            with open("/dump/failed_message.bin", "wb") as f:
-                                f.write(messages[0])
-                            logger.error("Binary data written to failed_message.bin for analysis")
-                    except Exception as write_exc:
-                        logger.error(f"Failed to write binary data: {write_exc}")
-                    traceback.print_exc()
+                    # to make sure that response was sent
                     if (self.send_answer):
-                        self.socket.send_string(f"failed to process request: {str(e)}")
+                        await self.socket.send_string(f"failed to process request: {str(e)}")
+                    traceback.print_exc()
+                    logger.error(e)
+                    logger.error(len(messages))
+        finally:
+            await dispatcher.close()
 
-            except zmq.error.Again as excp:
-                #pass
-                if(excp.errno != 11):
-                    logger.error(self.IPCConnection_Control)
-                    logger.error(excp.errno)
-                    logger.error(excp)
-                    self.connect(False)
-             
+    async def handleMessage(self, messages: list, dispatcher: "CallbackDispatcher",
+                            isMsgpack: bool = True, concurrentCallbacks: bool = False,
+                            receivedAt: float = None) -> None:
+        try:
+            started = time.perf_counter()
+            if receivedAt is None:
+                receivedAt = started
+            metrics = self.metrics
+            metrics.observe("recv", started - receivedAt)
+            image_pack = self.unpackMessage(messages, isMsgpack)
+            if image_pack is None:
+                return
+            unpacked = time.perf_counter()
+            metrics.observe("unpack", unpacked - started)
+            dataformat = image_pack.get("dataformat")
+            if isinstance(dataformat, dict):
+                timestamp = dataformat.get("timestamp")
+                # camera timestamps are epoch milliseconds
+                if isinstance(timestamp, (int, float)) and timestamp > 1e12:
+                    metrics.observe("age", max(time.time() - timestamp / 1000.0, 0.0))
+
+            matches = dispatcher.match(image_pack)
+            size = messageSize(messages)
+            result = None
+            if concurrentCallbacks:
+                await dispatcher.schedule(matches, image_pack, size)
+            else:
+                result = await dispatcher.call(matches, image_pack, size)
+                metrics.observe("callback", time.perf_counter() - unpacked)
+
+            if (not matches):
+                IPCLogging.event(self.IPCConnection_Control, "No callback for keys %s", list(image_pack))
+            elif (not logger.isEnabledFor(logging.DEBUG)):
+                pass
+            elif ("data" not in image_pack):
+                logger.debug("FOUND: %s", json.dumps(image_pack, indent=4, default=str))
+            else:
+                logger.debug("Found key %s", matches[-1][1])
+            del image_pack
+            if (self.send_answer):
+                replyStarted = time.perf_counter()
+                if(result is not None):
+                    await self.socket.send(result)
+                else:
+                    await self.socket.send(msgpack.dumps("OK"))
+                # logger.info("Sent answer")
+                metrics.observe("reply", time.perf_counter() - replyStarted)
+            metrics.observe("total", time.perf_counter() - receivedAt)
+        except Exception as e:
+            # logger.error(messages)
+            logger.error(e)
+            logger.error("Failed to process message")
+            # Keep the binary data for analysis, written in the background
+            try:
+                if isinstance(messages, list) and len(messages) > 0 and isinstance(messages[0], (bytes, bytearray)):
+                    if self.dumps.record("failed_message", messages, e, self.IPCConnection_Control):
+                        logger.error(f"Binary data queued for {self.dumps.directory} for analysis")
+            except Exception as write_exc:
+                logger.error(f"Failed to record binary data: {write_exc}")
+            traceback.print_exc()
+            if (self.send_answer):
+                await self.socket.send_string(f"failed to process request: {str(e)}")
+
+
+class CallbackDispatcher:
+    # Looks up the callbacks of a message by its keys instead of scanning every
+    # callback, and runs them inline, on an executor or as concurrent tasks.
+
+    def __init__(self, callbacks: Dict[str, SocketCallback], id: int = -1,
+                 executor: Union[concurrent.futures.Executor, int] = None,
+                 orderedKeys: list = None, maxInFlight: int = 16, metrics: IPCMetrics = None,
+                 resolveShared: Callable = None) -> None:
+        self.id = id
+        self.metrics = metrics
+        # callbacks decorated with a FrameView get image_pack["image"] cut to that view
+        self.index = {key: (position, key, fn, inspect.iscoroutinefunction(fn), getattr(fn, "frameView", None))
+                      for position, (key, fn) in enumerate(callbacks.items())}
+        self.resolveShared = resolveShared
+        self.ownsExecutor = isinstance(executor, int)
+        if self.ownsExecutor:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=executor, thread_name_prefix="callback")
+        self.executor = executor
+        self.orderedKeys = set(orderedKeys) if orderedKeys is not None else set()
+        self.inFlight = asyncio.Semaphore(maxInFlight)
+        self.tasks = set()
+        self.lanes: Dict[str, asyncio.Task] = {}
+
+    def match(self, image_pack: dict) -> list:
+        matches = [self.index[key] for key in image_pack if key in self.index]
+        if len(matches) > 1:
+            # callbacks are called in the order they were registered
+            matches.sort()
+        return matches
+
+    async def view(self, view: FrameView, image_pack: dict) -> dict:
+        dataformat = image_pack.get("dataformat")
+        if not isinstance(dataformat, dict):
+            return image_pack
+        if image_pack.get("data") is None and "shm" in image_pack and self.resolveShared is not None:
+            image = view.applyArray(self.resolveShared(image_pack))
+        elif "data" not in image_pack:
+            return image_pack
+        elif dataformat.get("type") in FrameCodec.ENCODED:
+            codec = FrameCodec.default()
+            image = await asyncio.get_running_loop().run_in_executor(
+                codec.executor, view.apply, image_pack["data"], dataformat)
+        else:
+            image = view.apply(image_pack["data"], dataformat)
+        # other callbacks of the message still see the unchanged pack
+        return {**image_pack, "image": image}
+
+    async def invoke(self, entry: tuple, image_pack: dict, size: int = 0):
+        _, key, fn, isCoroutine, view = entry
+        started = time.perf_counter()
+        if view is not None:
+            image_pack = await self.view(view, image_pack)
+        args = (image_pack, self.id) if self.id >= 0 else (image_pack,)
+        try:
+            if isCoroutine:
+                return await fn(*args)
+            if self.executor is not None:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+            return fn(*args)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observeKey(key, time.perf_counter() - started, size)
+
+    async def call(self, matches: list, image_pack: dict, size: int = 0):
+        # sequential, the result of the last callback is the answer
+        result = None
+        for entry in matches:
+            result = await self.invoke(entry, image_pack, size)
+        return result
+
+    async def schedule(self, matches: list, image_pack: dict, size: int = 0) -> None:
+        for entry in matches:
+            await self.inFlight.acquire()
+            key = entry[1]
+            previous = self.lanes.get(key) if key in self.orderedKeys else None
+            task = asyncio.create_task(self._run(entry, image_pack, previous, size))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            if key in self.orderedKeys:
+                self.lanes[key] = task
+
+    async def _run(self, entry: tuple, image_pack: dict, previous: asyncio.Task, size: int = 0) -> None:
+        try:
+            if previous is not None and not previous.done():
+                await asyncio.wait([previous])
+            await self.invoke(entry, image_pack, size)
+        except Exception as e:
+            logger.error(f"Callback {entry[1]} failed: {e}")
+            traceback.print_exc()
+        finally:
+            self.inFlight.release()
+            if self.lanes.get(entry[1]) is asyncio.current_task():
+                del self.lanes[entry[1]]
+
+    async def close(self) -> None:
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        if self.ownsExecutor:
+            self.executor.shutdown(wait=False)
+
+
+class ConnectionPool:
+    # SocketInterfaces keyed by endpoint, socket type and bind, so control channels
+    # like ipc:///signals/cam.control.N are reused instead of opened per request.
+    # Unhealthy connections (closed, or repeated send/receive errors) are replaced.
+
+    def __init__(self, context: zmq.asyncio.Context = None, maxFailures: int = 3) -> None:
+        self.context = context
+        self.maxFailures = maxFailures
+        self.connections: Dict[tuple, SocketInterface] = {}
+
+    def acquire(self, endpoint: str, type: zmq.SocketType = zmq.SocketType.REQ,
+                bind: bool = False, **kwargs) -> SocketInterface:
+        key = (endpoint, int(type), bind)
+        connection = self.connections.get(key)
+        if connection is not None and not connection.isHealthy(self.maxFailures):
+            logger.warning(f"Replacing unhealthy connection to {endpoint}")
+            connection.close()
+            connection = None
+        if connection is None:
+            if self.context is not None:
+                kwargs.setdefault("context", self.context)
+            connection = SocketInterface(endpoint, bind=bind, type=type, **kwargs)
+            self.connections[key] = connection
+        return connection
+
+    def checkHealth(self) -> int:
+        # reconnects every unhealthy connection, returns how many were replaced
+        replaced = 0
+        for connection in self.connections.values():
+            if not connection.isHealthy(self.maxFailures):
+                connection.connect(False)
+                connection.failures = 0
+                replaced += 1
+        return replaced
+
+    async def monitor(self, interval: float = 10.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            replaced = self.checkHealth()
+            if replaced:
+                logger.warning(f"Reconnected {replaced} unhealthy connections")
+
+    def release(self, endpoint: str, type: zmq.SocketType = zmq.SocketType.REQ, bind: bool = False) -> None:
+        connection = self.connections.pop((endpoint, int(type), bind), None)
+        if connection is not None:
+            connection.close()
+
+    def closeAll(self) -> None:
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+
+class CameraFanIn:
+    # Receives several cameras in one loop and hands out frames taken at the same
+    # time as one tuple, ordered like the endpoints. Frames are matched by
+    # dataformat.timestamp (epoch ms, receipt time if the camera sends none) within
+    # tolerance ms. Every camera has a bounded buffer, frames that overflow it or
+    # can no longer be matched are dropped and reported through onDrop and stats().
+    #
+    #   fanIn = CameraFanIn.forCameras(count=2, tolerance=5)
+    #   await fanIn.loop(lambda frames: ...)
+
+    def __init__(self, endpoints: list, tolerance: float = 5.0, maxBuffered: int = 4,
+                 onDrop: Callable = None, zeroCopy: bool = False, **kwargs) -> None:
+        self.sockets = []
+        for index, endpoint in enumerate(endpoints):
+            socket = SocketInterface(endpoint, type=zmq.SocketType.SUB, id=index, zeroCopy=zeroCopy, **kwargs)
+            socket.subscribe()
+            self.sockets.append(socket)
+        self.tolerance = tolerance
+        self.buffers = [deque() for _ in endpoints]
+        self.maxBuffered = maxBuffered
+        self.onDrop = onDrop
+        self.cancelToken = False
+        self.groups = 0
+        self.dropped = [{"overflow": 0, "unmatched": 0} for _ in endpoints]
+
+    @classmethod
+    def forCameras(cls, host: str = None, count: int = 1, **kwargs) -> "CameraFanIn":
+        # cameras publish on <camera_send_host>N, e.g. ipc:///signals/cam.out.0
+        host = host or os.environ.get("camera_send_host", "ipc:///signals/cam.out.")
+        return cls([f"{host}{index}" for index in range(count)], **kwargs)
+
+    @staticmethod
+    def timestamp(image_pack: dict, receivedAt: float) -> float:
+        dataformat = image_pack.get("dataformat")
+        if isinstance(dataformat, dict):
+            timestamp = dataformat.get("timestamp")
+            if isinstance(timestamp, (int, float)):
+                return float(timestamp)
+        return receivedAt * 1000.0
+
+    def drop(self, camera: int, reason: str, entry: tuple) -> None:
+        self.dropped[camera][reason] += 1
+        if self.onDrop is not None:
+            try:
+                self.onDrop(camera, reason, entry[1])
+            except Exception as e:
+                logger.error(f"onDrop failed: {e}")
+
+    def add(self, camera: int, image_pack: dict, receivedAt: float = None) -> None:
+        buffer = self.buffers[camera]
+        entry = (self.timestamp(image_pack, time.time() if receivedAt is None else receivedAt), image_pack)
+        # cameras deliver in timestamp order, a late frame is put in place
+        if buffer and entry[0] < buffer[-1][0]:
+            position = bisect.bisect_right([timestamp for timestamp, _ in buffer], entry[0])
+            buffer.insert(position, entry)
+        else:
+            buffer.append(entry)
+        if len(buffer) > self.maxBuffered:
+            self.drop(camera, "overflow", buffer.popleft())
 
+    def match(self) -> list:
+        # returns the complete groups, frames older than a group are given up
+        groups = []
+        while all(self.buffers):
+            heads = [buffer[0][0] for buffer in self.buffers]
+            newest = max(heads)
+            if newest - min(heads) <= self.tolerance:
+                groups.append(tuple(buffer.popleft()[1] for buffer in self.buffers))
+                continue
+            # heads too far behind the newest head cannot be matched by any later frame
+            for camera, buffer in enumerate(self.buffers):
+                if newest - buffer[0][0] > self.tolerance:
+                    self.drop(camera, "unmatched", buffer.popleft())
+        self.groups += len(groups)
+        return groups
+
+    def register(self, poller: zmq.asyncio.Poller, registered: list) -> None:
+        # a reconnect (connect(), ConnectionPool health checks) replaces socket.socket,
+        # the poller has to watch the new one
+        for camera, socket in enumerate(self.sockets):
+            if registered[camera] is socket.socket:
+                continue
+            if registered[camera] is not None:
+                poller.unregister(registered[camera])
+            poller.register(socket.socket, zmq.POLLIN)
+            registered[camera] = socket.socket
+
+    async def receive(self, poller: zmq.asyncio.Poller, timeout: int) -> None:
+        ready = dict(await poller.poll(timeout))
+        for camera, socket in enumerate(self.sockets):
+            if socket.socket not in ready:
+                continue
+            while socket.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                try:
+                    messages = await socket.socket.recv_multipart(flags=zmq.NOBLOCK, copy=not socket.zeroCopy)
+                except zmq.error.Again:
+                    break
+                receivedAt = time.time()
+                if socket.zeroCopy:
+                    messages = [messages[0].bytes] + [frame.buffer for frame in messages[1:]]
+                socket.metrics.received(messageSize(messages))
+                if socket.recorder is not None:
+                    socket.recorder.record(messages)
+                image_pack = socket.unpackMessage(messages, True)
+                if image_pack is not None:
+                    self.add(camera, image_pack, receivedAt)
+
+    async def loop(self, callback: SocketCallback, timeout: int = 1000) -> None:
+        # callback gets one tuple of image packs per matched group, sync or async
+        poller = zmq.asyncio.Poller()
+        registered = [None] * len(self.sockets)
+        logger.info(f"Starting fan-in for {len(self.sockets)} cameras")
+        while not self.cancelToken:
+            try:
+                self.register(poller, registered)
+                try:
+                    await self.receive(poller, timeout)
+                except (asyncio.CancelledError, zmq.error.ZMQError):
+                    # closing a polled socket cancels the poll, a replaced socket is registered
+                    # again. a cancelled task (cancelling() from 3.11 on) still stops
+                    task = asyncio.current_task()
+                    cancelling = getattr(task, "cancelling", None)
+                    replaced = any(registered[camera] is not socket.socket
+                                   for camera, socket in enumerate(self.sockets))
+                    if not replaced or (cancelling is not None and cancelling()):
+                        raise
+                    logger.warning("Fan-in socket was replaced while polling")
+                for group in self.match():
+                    result = callback(group)
+                    if asyncio.iscoroutine(result):
+                        await result
             except Exception as e:
-                # to make sure that response was sent
-                if (self.send_answer):
-                    self.socket.send_string(f"failed to process request: {str(e)}")
                 traceback.print_exc()
-                logger.error(e)
-                logger.error(len(messages))
+                logger.error(f"Fan-in failed: {e}")
+
+    def stats(self) -> dict:
+        return {"groups": self.groups, "dropped": self.dropped,
+                "buffered": [len(buffer) for buffer in self.buffers]}
+
+    def close(self) -> None:
+        self.cancelToken = True
+        for socket in self.sockets:
+            socket.close()
+
+
+class AdaptiveLiveview:
+    # Liveview sender that keeps the consumer latency near targetLatency. Latency is
+    # the round trip of answering sockets, the time a frame waits in the send queue,
+    # or whatever the consumer reports through feedback(). A PUB socket (the usual
+    # liveview socket) has no round trip and its queue wait stays far below a slow
+    # link's lag, so there the owner has to call feedback() with the latency the
+    # consumer reports (e.g. the browser acknowledging frames over the websocket),
+    # on the loop send() runs on. Too slow: quality, then
+    # width, then frame rate are cut multiplicatively. Headroom: frame rate, then
+    # width, then quality come back step by step. Mono images can go out as WebP or
+    # PNG (monoFormat), which keeps edges intact at a similar size.
+    #
+    #   liveview = AdaptiveLiveview.forLink(socket, lte=runtimeSettings["show_lte"])
+    #   await liveview.send(image, meta)
+
+    def __init__(self, socket: SocketInterface, targetLatency: float = 0.2,
+                 quality: tuple = (30, 90), width: tuple = (320, None), fps: tuple = (2.0, 30.0),
+                 monoFormat: str = "jpg", holdOff: float = 1.0) -> None:
+        self.socket = socket
+        self.targetLatency = targetLatency
+        self.minQuality, self.maxQuality = quality
+        maxWidth = width[1] if width[1] is not None else defaultMaxWidthJpg()
+        self.minWidth, self.maxWidth = min(width[0], maxWidth), maxWidth
+        self.minFps, self.maxFps = fps
+        self.quality = self.maxQuality
+        self.width = self.maxWidth
+        self.fps = self.maxFps
+        self.monoFormat = monoFormat
+        self.holdOff = holdOff
+        self.latency = 0.0
+        self.lastSent = 0.0
+        self.lastChange = 0.0
+        self.lastDropped = 0
+        self.sent = 0
+        self.skipped = 0
+        if not socket.send_answer:
+            logger.info(f"Liveview {socket.IPCConnection_Control} gets no consumer round trip, "
+                        f"it only adapts to feedback()")
+
+    @classmethod
+    def forLink(cls, socket: SocketInterface, lte: bool = False, **kwargs) -> "AdaptiveLiveview":
+        # LTE operators start low and only get more when the link keeps up
+        if lte:
+            kwargs = {"targetLatency": 0.5, "quality": (20, 75), "width": (240, 800), "fps": (1.0, 10.0), **kwargs}
+        liveview = cls(socket, **kwargs)
+        if lte:
+            liveview.quality, liveview.width, liveview.fps = 50, 480, 5.0
+        return liveview
+
+    def feedback(self, latency: float) -> None:
+        # smoothed consumer latency in seconds
+        self.latency = latency if not self.latency else 0.8 * self.latency + 0.2 * latency
+
+    def congested(self) -> bool:
+        queue = self.socket.sendQueue
+        if queue is not None:
+            dropped = sum(queue.dropped.values())
+            if dropped > self.lastDropped or queue.qsize() > 1:
+                self.lastDropped = dropped
+                return True
+        return self.latency > self.targetLatency
+
+    def adapt(self, now: float) -> None:
+        if now - self.lastChange < self.holdOff:
+            return
+        if self.congested():
+            if self.quality > self.minQuality:
+                self.quality = max(self.minQuality, int(self.quality * 0.75))
+            elif self.width > self.minWidth:
+                self.width = max(self.minWidth, int(self.width * 0.75))
+            else:
+                self.fps = max(self.minFps, self.fps * 0.5)
+        elif self.latency < self.targetLatency * 0.5:
+            if self.fps < self.maxFps:
+                self.fps = min(self.maxFps, self.fps + 1.0)
+            elif self.width < self.maxWidth:
+                self.width = min(self.maxWidth, self.width + 64)
+            elif self.quality < self.maxQuality:
+                self.quality = min(self.maxQuality, self.quality + 5)
+            else:
+                return
+        else:
+            return
+        self.lastChange = now
+        logger.debug("Liveview %s: quality %d, width %d, %.1f fps, latency %.3fs",
+                     self.socket.IPCConnection_Control, self.quality, self.width, self.fps, self.latency)
+
+    def format(self, image: np.ndarray) -> str:
+        mono = image.ndim == 2 or image.shape[2] == 1
+        return self.monoFormat if mono else "jpg"
+
+    async def send(self, image: np.ndarray, meta: dict = None) -> bool:
+        # False if the frame was skipped to hold the current frame rate
+        now = time.monotonic()
+        if now - self.lastSent < 1.0 / self.fps:
+            self.skipped += 1
+            return False
+        self.lastSent = now
+        self.adapt(now)
+        format = self.format(image)
+        encoded, shape = await FrameCodec.default().encode(image, self.quality, self.width, format)
+        started = time.perf_counter()
+        sent = await self.socket.sendImageEncoded(encoded, shape, meta, format)
+        if isinstance(sent, concurrent.futures.Future):
+            # completes on the scheduler thread, feedback() belongs to this loop
+            loop = asyncio.get_running_loop()
+
+            def onSent(future: concurrent.futures.Future) -> None:
+                if future.cancelled() or future.exception() is not None or loop.is_closed():
+                    return
+                loop.call_soon_threadsafe(self.feedback, time.perf_counter() - started)
+            sent.add_done_callback(onSent)
+        elif self.socket.send_answer:
+            self.feedback(time.perf_counter() - started)
+        self.sent += 1
+        return True
+
+    def stats(self) -> dict:
+        return {"quality": self.quality, "width": self.width, "fps": self.fps, "latency": self.latency,
+                "sent": self.sent, "skipped": self.skipped}
@@ -0,0 +1,381 @@
+# Capture and replay of SocketInterface traffic.
+#
+# A recording is an append-only data file with every received multipart message
+# (header plus data frames) and an index file next to it with one fixed size entry
+# per message, so it can be memory mapped and read at any frame index or timestamp.
+#
+#   data file   FILE_MAGIC, then per message: record header, part sizes, part bytes
+#   index file  (offset, timestamp ns, record size) per message
+#
+# Frames sent through shared memory only carry a reference to the ring slot, those
+# recordings contain the headers but not the pixels.
+#
+#   python IPCRecorder.py record ipc:///signals/cam.out.0 /dump/cam.rec --seconds 30
+#   python IPCRecorder.py info /dump/cam.rec
+#   python IPCRecorder.py replay /dump/cam.rec ipc:///signals/cam.out.0 --bind --type PUB --mode original
+import argparse
+import asyncio
+import bisect
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from typing import Iterator, Union
+
+import numpy as np
+import zmq
+
+from IPCHelper import SocketInterface, messageSize
+
+logger = logging.getLogger(__name__)
+
+FILE_MAGIC = b"IPCREC01"
+# timestamp ns, number of parts
+RECORD = struct.Struct("<qI")
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("timestamp", "<i8"), ("size", "<u8")])
+
+
+class IPCRecorder:
+    # Appends messages from a background thread, record() never blocks the event
+    # loop. When the writer falls behind by more than maxQueue messages or
+    # maxPendingBytes, messages are dropped and counted.
+    def __init__(self, path: str, maxQueue: int = 256, maxBytes: int = 0,
+                 maxPendingBytes: int = 128 << 20) -> None:
+        self.path = path
+        self.maxBytes = maxBytes
+        self.maxPendingBytes = maxPendingBytes
+        self.pendingBytes = 0
+        self.pendingLock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.data = open(path, "ab")
+        if self.data.tell() == 0:
+            self.data.write(FILE_MAGIC)
+        self.index = open(path + ".idx", "ab")
+        self.offset = self.data.tell()
+        self.pending = queue.Queue(maxsize=maxQueue)
+        self.recorded = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.thread = threading.Thread(target=self._run, name="ipc-recorder", daemon=True)
+        self.thread.start()
+
+    def record(self, parts: list, timestamp: int = None) -> bool:
+        # parts may be bytes, memoryviews or zmq frames, they are written as is
+        if self.pending is None:
+            return False
+        if not isinstance(parts, list):
+            parts = [parts]
+        size = messageSize(parts)
+        with self.pendingLock:
+            if self.pendingBytes + size > self.maxPendingBytes:
+                self.dropped += 1
+                return False
+            self.pendingBytes += size
+        try:
+            self.pending.put_nowait((time.time_ns() if timestamp is None else timestamp, parts))
+            return True
+        except queue.Full:
+            with self.pendingLock:
+                self.pendingBytes -= size
+            self.dropped += 1
+            return False
+
+    def _run(self) -> None:
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch = [item]
+            # write everything that is already waiting in one go
+            while not self.pending.empty() and len(batch) < 64:
+                item = self.pending.get_nowait()
+                if item is None:
+                    break
+                batch.append(item)
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"Failed to write recording {self.path}: {e}")
+            finally:
+                with self.pendingLock:
+                    self.pendingBytes -= sum(messageSize(parts) for _, parts in batch)
+            if item is None:
+                break
+
+    def _write(self, batch: list) -> None:
+        entries = np.zeros(len(batch), dtype=INDEX_DTYPE)
+        written = 0
+        for timestamp, parts in batch:
+            sizes = [memoryview(part).nbytes for part in parts]
+            size = RECORD.size + 4 * len(sizes) + sum(sizes)
+            if self.maxBytes and self.offset + size > self.maxBytes:
+                self.dropped += 1
+                continue
+            self.data.write(RECORD.pack(timestamp, len(parts)))
+            self.data.write(struct.pack(f"<{len(sizes)}I", *sizes))
+            for part in parts:
+                self.data.write(part)
+            entries[written] = (self.offset, timestamp, size)
+            written += 1
+            self.offset += size
+            self.bytes += size
+        # the index only points at flushed data, a reader never sees half a record
+        self.data.flush()
+        self.index.write(entries[:written].tobytes())
+        self.index.flush()
+        self.recorded += written
+
+    def stats(self) -> dict:
+        return {"recorded": self.recorded, "dropped": self.dropped, "bytes": self.bytes,
+                "pending": self.pending.qsize() if self.pending is not None else 0,
+                "pendingBytes": self.pendingBytes}
+
+    def close(self) -> None:
+        if self.pending is None:
+            return
+        self.pending.put(None)
+        self.thread.join()
+        self.pending = None
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self) -> "IPCRecorder":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class IPCRecording:
+    # Read side, frames are memoryviews into the mapped data file and stay valid
+    # until close(). Records missing from the index are recovered from the data file.
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(FILE_MAGIC):
+            raise ValueError(f"{path} is not a recording")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(FILE_MAGIC)] != FILE_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a recording")
+        self.entries = self.loadIndex(size)
+        self.timestamps = self.entries["timestamp"].tolist()
+
+    def loadIndex(self, size: int) -> np.ndarray:
+        indexPath = self.path + ".idx"
+        entries = np.zeros(0, dtype=INDEX_DTYPE)
+        if os.path.exists(indexPath):
+            count = os.path.getsize(indexPath) // INDEX_DTYPE.itemsize
+            entries = np.fromfile(indexPath, dtype=INDEX_DTYPE, count=count)
+            # entries past the end of the data belong to an interrupted write
+            valid = entries["offset"] + entries["size"] <= size
+            if not valid.all():
+                entries = entries[:int(np.argmin(valid))]
+        # records written after the last index entry are found by scanning the data
+        end = int(entries[-1]["offset"] + entries[-1]["size"]) if len(entries) else len(FILE_MAGIC)
+        if end < size:
+            entries = np.concatenate([entries, self.scan(end, size)])
+        return entries
+
+    def scan(self, offset: int, size: int) -> np.ndarray:
+        entries = []
+        while offset + RECORD.size <= size:
+            timestamp, count = RECORD.unpack_from(self.map, offset)
+            if offset + RECORD.size + 4 * count > size:
+                break
+            sizes = struct.unpack_from(f"<{count}I", self.map, offset + RECORD.size)
+            length = RECORD.size + 4 * count + sum(sizes)
+            if offset + length > size:
+                break
+            entries.append((offset, timestamp, length))
+            offset += length
+        return np.array(entries, dtype=INDEX_DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, index: int) -> tuple[int, list]:
+        # (timestamp ns, [part, ...])
+        offset, timestamp, _ = self.entries[index].tolist()
+        _, count = RECORD.unpack_from(self.map, offset)
+        sizes = struct.unpack_from(f"<{count}I", self.map, offset + RECORD.size)
+        view = memoryview(self.map)
+        position = offset + RECORD.size + 4 * count
+        parts = []
+        for size in sizes:
+            parts.append(view[position:position + size])
+            position += size
+        return timestamp, parts
+
+    def indexAt(self, timestamp: int) -> int:
+        # first frame recorded at or after timestamp (ns)
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+    def frames(self, start: int = 0, stop: int = None) -> Iterator[tuple[int, list]]:
+        for index in range(start, len(self) if stop is None else min(stop, len(self))):
+            yield self[index]
+
+    @property
+    def duration(self) -> float:
+        if len(self) < 2:
+            return 0.0
+        return (self.timestamps[-1] - self.timestamps[0]) / 1e9
+
+    def info(self) -> dict:
+        return {"path": self.path, "frames": len(self),
+                "bytes": int(self.entries["size"].sum()) if len(self) else 0,
+                "start": self.timestamps[0] if len(self) else None,
+                "duration": self.duration}
+
+    def close(self) -> None:
+        # the map can only be closed once the frames handed out are released
+        try:
+            self.map.close()
+        except BufferError:
+            logger.warning(f"Frames of {self.path} still referenced, map stays open")
+        self.file.close()
+
+    def __enter__(self) -> "IPCRecording":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class IPCReplayer:
+    # Pushes a recording through a SocketInterface.
+    #   mode "original" keeps the recorded spacing (divided by speed)
+    #   mode "fixed"    sends at rate frames per second
+    #   mode "max"      sends as fast as the socket takes them
+    def __init__(self, recording: Union[IPCRecording, str], socket: SocketInterface) -> None:
+        self.recording = IPCRecording(recording) if isinstance(recording, str) else recording
+        self.socket = socket
+        self.sent = 0
+        self.late = 0
+        self.bytes = 0
+
+    async def run(self, mode: str = "original", rate: float = 30.0, speed: float = 1.0,
+                  start: int = 0, stop: int = None, loops: int = 1) -> dict:
+        if mode not in ("original", "fixed", "max"):
+            raise ValueError(f"Unknown replay mode {mode}")
+        started = time.perf_counter()
+        elapsed = 0.0
+        for _ in range(loops):
+            first = None
+            loopStart = time.perf_counter()
+            for position, (timestamp, parts) in enumerate(self.recording.frames(start, stop)):
+                if mode == "original":
+                    first = timestamp if first is None else first
+                    due = loopStart + (timestamp - first) / 1e9 / speed
+                elif mode == "fixed":
+                    due = loopStart + position / rate
+                else:
+                    due = None
+                if due is not None:
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    elif delay < -0.01:
+                        self.late += 1
+                await self.socket.sendMultipart(parts)
+                self.sent += 1
+                self.bytes += messageSize(parts)
+                if mode == "max":
+                    # let receivers on the same loop run
+                    await asyncio.sleep(0)
+        elapsed = time.perf_counter() - started
+        return {"sent": self.sent, "late": self.late, "bytes": self.bytes, "elapsed": elapsed,
+                "framesPerSecond": round(self.sent / elapsed, 2) if elapsed else None}
+
+
+async def recordEndpoint(endpoint: str, path: str, seconds: float = 0, frames: int = 0,
+                         bind: bool = False, type: zmq.SocketType = zmq.SocketType.SUB) -> dict:
+    socket = SocketInterface(endpoint, bind=bind, type=type)
+    if type == zmq.SocketType.SUB:
+        socket.subscribe()
+    recorder = IPCRecorder(path)
+    socket.attachRecorder(recorder)
+    loop = asyncio.create_task(socket.zmqloop({}))
+    started = time.monotonic()
+    try:
+        while not loop.done():
+            await asyncio.sleep(0.1)
+            if seconds and time.monotonic() - started >= seconds:
+                break
+            if frames and recorder.recorded + recorder.pending.qsize() >= frames:
+                break
+    finally:
+        socket.cancelToken = True
+        loop.cancel()
+        socket.attachRecorder(None)
+        recorder.close()
+        socket.close()
+    return recorder.stats()
+
+
+async def replayFile(path: str, endpoint: str, bind: bool = False, type: zmq.SocketType = zmq.SocketType.PUB,
+                     **kwargs) -> dict:
+    socket = SocketInterface(endpoint, bind=bind, type=type)
+    recording = IPCRecording(path)
+    try:
+        if type == zmq.SocketType.PUB:
+            # subscribers need a moment to connect before anything is published
+            await asyncio.sleep(0.5)
+        return await IPCReplayer(recording, socket).run(**kwargs)
+    finally:
+        # zero copy sends reference the map until the socket is done with them
+        socket.close(linger=2000)
+        recording.close()
+
+
+def main() -> None:
+    import json
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    record = commands.add_parser("record")
+    record.add_argument("endpoint")
+    record.add_argument("path")
+    record.add_argument("--seconds", type=float, default=0)
+    record.add_argument("--frames", type=int, default=0)
+    record.add_argument("--bind", action="store_true")
+    record.add_argument("--type", default="SUB")
+    info = commands.add_parser("info")
+    info.add_argument("path")
+    replay = commands.add_parser("replay")
+    replay.add_argument("path")
+    replay.add_argument("endpoint")
+    replay.add_argument("--bind", action="store_true")
+    replay.add_argument("--type", default="PUB")
+    replay.add_argument("--mode", default="original", choices=["original", "fixed", "max"])
+    replay.add_argument("--rate", type=float, default=30.0)
+    replay.add_argument("--speed", type=float, default=1.0)
+    replay.add_argument("--start", type=int, default=0, help="first frame index")
+    replay.add_argument("--stop", type=int, default=None, help="frame index to stop before")
+    replay.add_argument("--from-time", type=float, default=None, help="start at this epoch time in seconds")
+    replay.add_argument("--loops", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        result = asyncio.run(recordEndpoint(args.endpoint, args.path, args.seconds, args.frames,
+                                            args.bind, zmq.SocketType[args.type]))
+    elif args.command == "info":
+        with IPCRecording(args.path) as recording:
+            result = recording.info()
+    else:
+        start = args.start
+        if args.from_time is not None:
+            with IPCRecording(args.path) as recording:
+                start = recording.indexAt(int(args.from_time * 1e9))
+        result = asyncio.run(replayFile(args.path, args.endpoint, args.bind, zmq.SocketType[args.type],
+                                        mode=args.mode, rate=args.rate, speed=args.speed,
+                                        start=start, stop=args.stop, loops=args.loops))
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
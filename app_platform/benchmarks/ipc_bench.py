@@ -0,0 +1,255 @@
+# Reproducible SocketInterface benchmark for the camera -> backend -> app flows.
+#
+# Every scenario starts a receiver process running zmqloop and a sender process
+# pushing synthetic frames through sendImage / sendImageEncoded, so the CPU and
+# peak RSS of each side are measured on their own process. One JSON object
+# per scenario is written to stdout (and --output), so runs can be diffed.
+#
+#   python benchmarks/ipc_bench.py                       # full matrix
+#   python benchmarks/ipc_bench.py --transports ipc --patterns pubsub --payloads rgb --frames 200
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IPCHelper import SendPolicy, SocketInterface, defaultMaxWidthJpg  # noqa: E402
+
+CAMERA_MAX_WIDTH_JPG = defaultMaxWidthJpg()
+
+PAYLOADS = {
+    "mono": (1944, 2592, 1),
+    "rgb": (2235, 2592, 3),
+    "jpg": (2235, 2592, 3),
+}
+
+# sender socket type, receiver socket type, receiver binds
+PATTERNS = {
+    "pubsub": (zmq.SocketType.PUB, zmq.SocketType.SUB, False),
+    "reqrep": (zmq.SocketType.REQ, zmq.SocketType.REP, True),
+    "pair": (zmq.SocketType.PAIR, zmq.SocketType.PAIR, True),
+}
+
+
+def syntheticImage(shape: tuple) -> np.ndarray:
+    # gradient plus noise, compresses roughly like a real scene
+    rows, cols, channels = shape
+    gradient = np.add.outer(np.arange(rows), np.arange(cols)) % 256
+    image = np.repeat(gradient[:, :, None], channels, axis=2).astype(np.uint8)
+    noise = np.random.default_rng(0).integers(0, 16, shape, dtype=np.uint8)
+    return image + noise
+
+
+def encodeJpg(image: np.ndarray) -> tuple[bytes, tuple]:
+    if image.shape[1] > CAMERA_MAX_WIDTH_JPG:
+        scale = CAMERA_MAX_WIDTH_JPG / image.shape[1]
+        image = cv2.resize(image, (CAMERA_MAX_WIDTH_JPG, int(image.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode(".jpg", image)
+    return encoded.tobytes(), (image.shape[1], image.shape[0], image.shape[2])
+
+
+def usage() -> dict:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpuUser": own.ru_utime, "cpuSystem": own.ru_stime, "peakRssKb": own.ru_maxrss}
+
+
+def quantile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def receiver(endpoint: str, socketType: int, bind: bool, frames: int, decode: bool, timeout: float,
+             ready, results) -> None:
+    async def run():
+        socket = SocketInterface(endpoint, bind=bind, type=zmq.SocketType(socketType))
+        if socketType == zmq.SUB:
+            socket.subscribe()
+        latencies = []
+        sizes = []
+        first = last = None
+        done = asyncio.Event()
+        before = usage()
+
+        def onFrame(message: dict):
+            nonlocal first, last
+            now = time.monotonic_ns()
+            if message.get("meta", {}).get("warmup"):
+                return
+            if decode:
+                socket.castImage(message)
+            latencies.append((time.monotonic_ns() - message["meta"]["sent"]) / 1e9)
+            sizes.append(len(message["data"]))
+            first = first if first is not None else now
+            last = now
+            if len(latencies) >= frames:
+                socket.cancelToken = True
+                done.set()
+
+        loop = asyncio.create_task(socket.zmqloop({"meta": onFrame}))
+        ready.set()
+        try:
+            await asyncio.wait_for(done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.sleep(0.05)
+        loop.cancel()
+        after = usage()
+        elapsed = (last - first) / 1e9 if first is not None and last != first else 0.0
+        results.put({
+            "received": len(latencies),
+            "elapsed": elapsed,
+            "bytes": sum(sizes),
+            "latencies": latencies,
+            "cpuUser": after["cpuUser"] - before["cpuUser"],
+            "cpuSystem": after["cpuSystem"] - before["cpuSystem"],
+            "peakRssKb": after["peakRssKb"],
+        })
+
+    asyncio.run(run())
+
+
+async def sender(endpoint: str, socketType: int, bind: bool, payload: str, frames: int,
+                 queueSending: bool, rate: float) -> dict:
+    # the queue defaults to LATEST on prio 0, which would drop frames the benchmark counts
+    socket = SocketInterface(endpoint, bind=not bind, type=zmq.SocketType(socketType), queueSending=queueSending,
+                             queuePolicy=SendPolicy.BLOCK, queuePolicies={0: SendPolicy.BLOCK})
+    image = syntheticImage(PAYLOADS[payload])
+    encoded, shape = encodeJpg(image) if payload == "jpg" else (None, None)
+
+    async def push(meta: dict):
+        if payload == "jpg":
+            await socket.sendImageEncoded(encoded, shape, meta)
+        else:
+            await socket.sendImage(image, meta)
+
+    # pub/sub drops everything sent before the subscription is established
+    if socketType == zmq.PUB:
+        for _ in range(5):
+            await push({"warmup": True, "sent": time.monotonic_ns()})
+            await asyncio.sleep(0.05)
+
+    before = usage()
+    interval = 1.0 / rate if rate else 0.0
+    started = time.monotonic()
+    for index in range(frames):
+        if interval:
+            delay = started + index * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await push({"sent": time.monotonic_ns(), "index": index})
+        await asyncio.sleep(0)
+    if socket.sendQueue is not None:
+        while socket.sendQueue.qsize():
+            await asyncio.sleep(0.01)
+    after = usage()
+    result = {"cpuUser": after["cpuUser"] - before["cpuUser"],
+              "cpuSystem": after["cpuSystem"] - before["cpuSystem"],
+              "peakRssKb": after["peakRssKb"],
+              "dropped": socket.droppedFrames}
+    # give pub/sub time to flush before the socket goes away
+    socket.close(linger=2000)
+    return result
+
+
+def senderMain(endpoint: str, socketType: int, bind: bool, payload: str, frames: int,
+               queueSending: bool, rate: float, results) -> None:
+    results.put(asyncio.run(sender(endpoint, socketType, bind, payload, frames, queueSending, rate)))
+
+
+def runScenario(transport: str, pattern: str, payload: str, queueSending: bool, args, directory: str) -> dict:
+    if transport == "ipc":
+        endpoint = f"ipc://{directory}/bench.{pattern}.{payload}.{int(queueSending)}"
+    else:
+        with zmq.Context() as context, context.socket(zmq.PAIR) as probe:
+            port = probe.bind_to_random_port("tcp://127.0.0.1")
+        endpoint = f"tcp://127.0.0.1:{port}"
+    senderType, receiverType, receiverBinds = PATTERNS[pattern]
+
+    spawn = multiprocessing.get_context("spawn")
+    ready = spawn.Event()
+    results = spawn.Queue()
+    process = spawn.Process(target=receiver, args=(endpoint, int(receiverType), receiverBinds, args.frames,
+                                                   not args.no_decode, args.timeout, ready, results))
+    process.start()
+    ready.wait(30)
+    sentResults = spawn.Queue()
+    senderProcess = spawn.Process(target=senderMain, args=(endpoint, int(senderType), receiverBinds, payload,
+                                                           args.frames, queueSending, args.rate, sentResults))
+    senderProcess.start()
+    sent = sentResults.get(timeout=args.timeout + 30)
+    received = results.get(timeout=args.timeout + 30)
+    senderProcess.join(10)
+    process.join(10)
+
+    latencies = received.pop("latencies")
+    elapsed = received["elapsed"]
+    return {
+        "transport": transport,
+        "pattern": pattern,
+        "payload": payload,
+        "shape": list(PAYLOADS[payload]),
+        "queueSending": queueSending,
+        "frames": args.frames,
+        "received": received["received"],
+        "framesPerSecond": round((received["received"] - 1) / elapsed, 2) if elapsed else None,
+        "megabytesPerSecond": round(received["bytes"] / elapsed / 1e6, 2) if elapsed else None,
+        "latencyP50Ms": round(quantile(latencies, 0.5) * 1000, 3),
+        "latencyP99Ms": round(quantile(latencies, 0.99) * 1000, 3),
+        "latencyMaxMs": round(max(latencies) * 1000, 3) if latencies else None,
+        "sender": sent,
+        "receiver": {key: received[key] for key in ("cpuUser", "cpuSystem", "peakRssKb")},
+    }
+
+
+def environment() -> dict:
+    return {"python": platform.python_version(), "machine": platform.machine(),
+            "platform": platform.platform(), "cpus": os.cpu_count(),
+            "zmq": zmq.zmq_version(), "pyzmq": zmq.__version__, "numpy": np.__version__,
+            "opencv": cv2.__version__, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transports", nargs="+", default=["ipc", "tcp"], choices=["ipc", "tcp"])
+    parser.add_argument("--patterns", nargs="+", default=list(PATTERNS), choices=list(PATTERNS))
+    parser.add_argument("--payloads", nargs="+", default=list(PAYLOADS), choices=list(PAYLOADS))
+    parser.add_argument("--queue", nargs="+", default=["off", "on"], choices=["off", "on"])
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=0.0, help="frames per second, 0 = as fast as possible")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--no-decode", action="store_true", help="skip castImage on the receiver")
+    parser.add_argument("--output", help="also append the results as JSON lines to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="ipcbench")
+    env = environment()
+    output = open(args.output, "a") if args.output else None
+    try:
+        for transport, pattern, payload, queue in itertools.product(args.transports, args.patterns,
+                                                                     args.payloads, args.queue):
+            result = runScenario(transport, pattern, payload, queue == "on", args, directory)
+            result["environment"] = env
+            line = json.dumps(result)
+            print(line, flush=True)
+            if output is not None:
+                output.write(line + "\n")
+    finally:
+        if output is not None:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
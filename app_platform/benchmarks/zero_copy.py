@@ -0,0 +1,103 @@
+# Bytes copied per frame for the legacy and the zero-copy SocketInterface path.
+#
+# Send side python allocations (tobytes()) are measured with tracemalloc. The copy
+# libzmq makes when sending with copy=True happens outside the python heap and is
+# added from the frame size. On the receive side every payload that arrives as a
+# bytes object instead of a view onto the zmq frame counts as one copy.
+#
+#   python benchmarks/zero_copy.py --frames 50
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IPCHelper import SocketInterface  # noqa: E402
+
+SHAPES = {
+    "mono": (1944, 2592, 1),
+    "rgb": (2235, 2592, 3),
+}
+
+
+async def runMode(zeroCopy: bool, shape: tuple, frames: int, endpoint: str) -> dict:
+    sender = SocketInterface(endpoint, bind=True, type=zmq.SocketType.PAIR, zeroCopy=zeroCopy)
+    receiver = SocketInterface(endpoint, bind=False, type=zmq.SocketType.PAIR, zeroCopy=zeroCopy)
+    # pair sockets answer every message, the benchmark only measures one direction
+    sender.send_answer = False
+    receiver.send_answer = False
+
+    image = np.random.randint(0, 255, shape, dtype=np.uint8)
+    received = []
+    recvCopied = 0
+    done = asyncio.Event()
+
+    def onFrame(message: dict):
+        nonlocal recvCopied
+        if isinstance(message["data"], bytes):
+            recvCopied += len(message["data"])
+        received.append(receiver.castImage(message).shape)
+        if len(received) >= frames:
+            receiver.cancelToken = True
+            done.set()
+
+    sendAllocated = 0
+    tracemalloc.start()
+    loop = asyncio.create_task(receiver.zmqloop({"dataformat": onFrame}))
+    await asyncio.sleep(0.1)
+    start = time.perf_counter()
+    for _ in range(frames):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await sender.sendImage(image)
+        if zeroCopy:
+            await sender.waitSent()
+        sendAllocated += tracemalloc.get_traced_memory()[1] - before
+        await asyncio.sleep(0)
+    await asyncio.wait_for(done.wait(), 60)
+    elapsed = time.perf_counter() - start
+    totalAllocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    loop.cancel()
+
+    frameBytes = image.nbytes
+    libzmqCopy = 0 if zeroCopy else frameBytes
+    sendPerFrame = sendAllocated / frames
+    recvPerFrame = recvCopied / frames
+    return {
+        "mode": "zerocopy" if zeroCopy else "legacy",
+        "shape": list(shape),
+        "frameBytes": frameBytes,
+        "frames": frames,
+        "sendPythonBytesPerFrame": int(sendPerFrame),
+        "sendLibzmqBytesPerFrame": libzmqCopy,
+        "recvBytesCopiedPerFrame": int(recvPerFrame),
+        "peakPythonBytes": totalAllocated,
+        "copiesPerFrame": round((sendPerFrame + libzmqCopy + recvPerFrame) / frameBytes, 2),
+        "framesPerSecond": round(frames / elapsed, 1),
+    }
+
+
+async def main(args) -> None:
+    directory = tempfile.mkdtemp(prefix="zerocopy")
+    results = []
+    for name in args.shapes:
+        for zeroCopy in (False, True):
+            endpoint = f"ipc://{directory}/{name}.{int(zeroCopy)}"
+            results.append(await runMode(zeroCopy, SHAPES[name], args.frames, endpoint))
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--shapes", nargs="+", default=list(SHAPES), choices=list(SHAPES))
+    asyncio.run(main(parser.parse_args()))